@@ -0,0 +1,171 @@
+import argparse
+import csv
+import json
+import os
+import shlex
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from election import SingleTransferableVote, Trace
+
+# every reader returns (seats, candidates, groups, total votes), groups being (ranking, count) pairs
+def read_election(path: str, seats: int = None):
+	# ballot files saved by the bot, binary or the old pickle format
+	election = SingleTransferableVote.load(path)
+	return seats or election.seats, sorted(election.candidates), election.group_votes(), len(election.votes)
+
+def read_blt(path: str, seats: int = None):
+	# see https://www.opavote.com/help/overview#blt-file-format
+	with open(path) as file:
+		lines = (line.split("#")[0].strip() for line in file)
+		lines = (line for line in lines if line != "")
+
+		def next_line():
+			line = next(lines, None)
+			if line is None:
+				raise ValueError(f"{path} ends early")
+			return line
+
+		candidate_count, blt_seats = [int(value) for value in next_line().split()]
+		rankings = Counter()
+		total_votes = 0
+		withdrawn = set()
+
+		line = next_line()
+		if line.startswith("-"):
+			withdrawn = {-int(value) for value in line.split()}
+			line = next_line()
+
+		# ballot lines are "weight first second ... 0", a lone "0" ends them.
+		# identical ballots are added up as they are read, the file is never held in memory
+		while line != "0":
+			values = line.split()
+			# skip the optional ballot id
+			if values[0].startswith("("):
+				values = values[1:]
+			if any("=" in value for value in values):
+				raise ValueError(f"{path} has equal rankings, they are not supported")
+
+			weight = int(values[0])
+			ranking = tuple(int(value) for value in values[1:-1] if int(value) not in withdrawn)
+			rankings[ranking] += weight
+			total_votes += weight
+			line = next_line()
+
+		names = [shlex.split(next_line())[0] for _ in range(candidate_count)]
+
+	candidates = [name for i, name in enumerate(names) if i + 1 not in withdrawn]
+	groups = [
+		(tuple(names[i - 1] for i in ranking), count)
+		for ranking, count in rankings.items() if ranking != ()
+	]
+	return seats or blt_seats, candidates, groups, total_votes
+
+def read_csv(path: str, seats: int = None):
+	# a header row of candidate names, then one row per ballot with the rank given to each candidate
+	if seats is None:
+		raise ValueError(f"{path} is a csv file, those need --seats")
+
+	with open(path, newline = "") as file:
+		reader = csv.reader(file)
+		candidates = next(reader, [])
+		rankings = Counter()
+		total_votes = 0
+		for row in reader:
+			ranks = [(int(rank), candidate) for candidate, rank in zip(candidates, row) if rank.strip() != ""]
+			if len({rank for rank, candidate in ranks}) < len(ranks):
+				raise ValueError(f"{path} has equal rankings, they are not supported")
+			rankings[tuple(candidate for rank, candidate in sorted(ranks))] += 1
+			total_votes += 1
+
+	groups = [(ranking, count) for ranking, count in rankings.items() if ranking != ()]
+	return seats, candidates, groups, total_votes
+
+formats = {
+	"election": read_election,
+	"blt": read_blt,
+	"csv": read_csv,
+}
+
+def detect_format(path: str):
+	extension = os.path.splitext(path)[1].lower()
+	return {".blt": "blt", ".csv": "csv"}.get(extension, "election")
+
+def count_file(path: str, file_format: str, seats: int, backend: str, arithmetic: str, tie_break: list[str], trace: bool):
+	result = {"file": path, "format": file_format}
+	try:
+		seats, candidates, groups, total_votes = formats[file_format](path, seats)
+		result.update({"seats": seats, "candidates": candidates, "ballots": total_votes, "distinct_ballots": len(groups)})
+
+		election = SingleTransferableVote(seats, candidates)
+		events = Trace()
+		if trace:
+			election.listeners.append(events)
+		result["elected"] = sorted(election.count(groups, total_votes, backend, arithmetic = arithmetic, tie_break = tie_break))
+		result["iterations"] = election.iterations
+		if trace:
+			result["trace"] = events.events
+	except Exception as error:
+		# one broken file must not stop the rest of the batch
+		result["error"] = f"{type(error).__name__}: {error}"
+	return result
+
+def expand(paths: list[str]):
+	# directories stand for every ballot file in them, journals are read along with their snapshot
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if not name.endswith(".log") and os.path.isfile(os.path.join(path, name)):
+					yield os.path.join(path, name)
+		else:
+			yield path
+
+def main():
+	parser = argparse.ArgumentParser(description = "Count exported ballot files and write the results to JSON.")
+	parser.add_argument("paths", nargs = "+", help = "ballot files, or directories of them")
+	parser.add_argument("--format", choices = list(formats), help = "read every file as this format instead of going by extension")
+	parser.add_argument("--seats", type = int, help = "seats to fill instead of the number in the file, required for csv files")
+	parser.add_argument("--backend", default = "numpy", choices = ["numpy", "python"])
+	parser.add_argument("--arithmetic", default = "float", choices = ["float", "fixed"])
+	parser.add_argument(
+		"--tie-break", nargs = "+", choices = ["backwards", "forwards", "random"],
+		help = "tie break rules to try in turn, by default backwards, forwards, then random",
+	)
+	parser.add_argument("--trace", action = "store_true", help = "include every round of every count")
+	parser.add_argument("--jobs", type = int, default = os.cpu_count(), help = "elections counted at the same time")
+	parser.add_argument("--output", default = "-", help = "results file, - for stdout")
+	args = parser.parse_args()
+
+	paths = list(expand(args.paths))
+	output = sys.stdout if args.output == "-" else open(args.output, "w")
+	failed = 0
+
+	with ProcessPoolExecutor(args.jobs) as pool:
+		futures = [
+			pool.submit(
+				count_file, path, args.format or detect_format(path), args.seats, args.backend, args.arithmetic,
+				args.tie_break, args.trace,
+			)
+			for path in paths
+		]
+
+		# write every result as soon as it and the ones before it are done, one per line
+		print("[", file = output)
+		for i, future in enumerate(futures):
+			result = future.result()
+			if "error" in result:
+				failed += 1
+				print(f"{result['file']}: {result['error']}", file = sys.stderr)
+			separator = "," if i + 1 < len(futures) else ""
+			print(json.dumps(result) + separator, file = output, flush = True)
+		print("]", file = output)
+
+	if output is not sys.stdout:
+		output.close()
+
+	print(f"counted {len(paths) - failed} of {len(paths)} elections", file = sys.stderr)
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from election import SingleTransferableVote, numpy
+
+# synthetic ballot generators, each yields an endless stream of rankings of `candidates`
+def uniform(rng: random.Random, candidates: list[str]):
+	while True:
+		yield rng.sample(candidates, len(candidates))
+
+def polarised(rng: random.Random, candidates: list[str]):
+	# two blocs, voters rank their own bloc first and mostly keep its usual order
+	half = len(candidates) // 2
+	while True:
+		blocs = [candidates[:half], candidates[half:]]
+		if rng.random() < 0.5:
+			blocs.reverse()
+
+		ranking = []
+		for bloc in blocs:
+			bloc = bloc.copy()
+			for _ in range(len(bloc) // 4):
+				i, j = rng.randrange(len(bloc)), rng.randrange(len(bloc))
+				bloc[i], bloc[j] = bloc[j], bloc[i]
+			ranking += bloc
+		yield ranking
+
+def truncated(rng: random.Random, candidates: list[str]):
+	# most voters only rank a handful of candidates
+	while True:
+		length = min(len(candidates), 1 + int(rng.expovariate(1 / 3)))
+		yield rng.sample(candidates, length)
+
+def duplicate(rng: random.Random, candidates: list[str]):
+	# a small pool of popular rankings, picked with falling popularity
+	pool = [rng.sample(candidates, len(candidates)) for _ in range(20)]
+	weights = [1 / (i + 1) for i in range(len(pool))]
+	while True:
+		yield rng.choices(pool, weights)[0]
+
+distributions = {
+	"uniform": uniform,
+	"polarised": polarised,
+	"truncated": truncated,
+	"duplicate": duplicate,
+}
+
+def build(distribution: str, voters: int, candidates: int, seats: int, seed: int):
+	rng = random.Random(seed)
+	names = [f"candidate{i}" for i in range(candidates)]
+	election = SingleTransferableVote(seats, names)
+	rankings = distributions[distribution](rng, names)
+	for user in range(voters):
+		election.Vote.from_list(next(rankings), user)
+	return election
+
+def measure(function, memory: bool):
+	# time without tracemalloc, it slows allocation heavy code down a lot
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):
+		try:
+			result = function()
+		except AssertionError as assertion:
+			result = assertion
+	seconds = time.perf_counter() - start
+
+	peak = None
+	if memory:
+		tracemalloc.start()
+		with contextlib.redirect_stdout(io.StringIO()):
+			try:
+				function()
+			except AssertionError:
+				pass
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+
+	return result, {"seconds": seconds, "peak_bytes": peak}
+
+def benchmark(
+	distribution: str, voters: int, candidates: int, seats: int, seed: int, backend: str, arithmetic: str, processes: int,
+	memory: bool,
+):
+	election = build(distribution, voters, candidates, seats, seed)
+	row = {
+		"distribution": distribution,
+		"voters": voters,
+		"candidates": candidates,
+		"seats": seats,
+		"backend": backend,
+		"arithmetic": arithmetic,
+		"processes": processes,
+		"distinct_ballots": len(election.group_votes()),
+	}
+
+	# every run is a cold count, the second one measure does for memory must not reuse the first
+	result, row["run"] = measure(
+		lambda: election.run(backend, warm = False, arithmetic = arithmetic, processes = processes), memory,
+	)
+	if isinstance(result, AssertionError):
+		row["error"] = str(result)
+	else:
+		row["elected"] = sorted(result)
+	row["iterations"] = election.iterations
+
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, "votes")
+		_, row["save"] = measure(lambda: election.save(filename), memory)
+		row["file_bytes"] = os.path.getsize(filename)
+		_, row["load"] = measure(lambda: SingleTransferableVote.load(filename), memory)
+
+	return row
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark vote counting and ballot storage on synthetic elections.")
+	parser.add_argument("--distributions", nargs = "+", default = list(distributions), choices = list(distributions))
+	parser.add_argument("--voters", nargs = "+", type = int, default = [100, 1_000, 10_000, 100_000, 1_000_000])
+	parser.add_argument("--candidates", nargs = "+", type = int, default = [3, 10, 30, 100])
+	parser.add_argument("--seats", nargs = "+", type = int, default = [1, 3, 10])
+	parser.add_argument("--backend", default = "numpy", choices = ["numpy", "python"])
+	parser.add_argument("--arithmetic", default = "float", choices = ["float", "fixed"])
+	parser.add_argument("--processes", type = int, default = 1, help = "processes sharing each counting pass")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--no-memory", action = "store_true", help = "skip peak memory measurement")
+	parser.add_argument("--quick", action = "store_true", help = "small sweep for a fast sanity check")
+	parser.add_argument("--output", default = "bench_output.json")
+	args = parser.parse_args()
+
+	if args.quick:
+		args.voters = [100, 1_000]
+		args.candidates = [3, 10]
+		args.seats = [1, 2]
+
+	results = []
+	for distribution in args.distributions:
+		for voters in args.voters:
+			for candidates in args.candidates:
+				for seats in args.seats:
+					# need more candidates than seats for there to be anything to count
+					if seats >= candidates:
+						continue
+
+					row = benchmark(
+						distribution, voters, candidates, seats, args.seed, args.backend, args.arithmetic, args.processes,
+						not args.no_memory,
+					)
+					results.append(row)
+					print(
+						f"{distribution:>9} {voters:>8} voters {candidates:>3} candidates {seats:>2} seats: "
+						f"run {row['run']['seconds']:.3f}s ({row['iterations']} iterations), "
+						f"save {row['save']['seconds']:.3f}s, load {row['load']['seconds']:.3f}s",
+						file = sys.stderr,
+					)
+
+	report = {
+		"python": platform.python_version(),
+		"numpy": numpy.__version__ if numpy is not None else None,
+		"machine": platform.machine(),
+		"seed": args.seed,
+		"results": results,
+	}
+	with open(args.output, "w") as file:
+		print(json.dumps(report, indent = "\t"), file=file)
+
+if __name__ == "__main__":
+	main()
@@ -1,14 +1,33 @@
 # This example requires the 'message_content' intent.
 
+import functools
+import re
+from collections import OrderedDict
+
 import discord
-import json
-import os
+
+from election import Trace
+from storage import BallotWriter, ElectionCache, ElectionRegistry, FileStore, SQLiteStore, Standings
+from workers import run_ballot_io, run_count, run_export
 
 intents = discord.Intents.default()
 intents.message_content = True
 
 client = discord.Client(intents=intents)
 
+# "sqlite" keeps all elections in elections/elections.db, "files" keeps one json file per election
+storage = "sqlite"
+if storage == "sqlite":
+	store = SQLiteStore("elections/elections.db")
+	# bring over elections kept as files by older versions
+	if store.created:
+		store.import_files(FileStore("elections"))
+else:
+	store = FileStore("elections")
+
+# election metadata, loaded once and written through to the store
+elections = ElectionRegistry(store)
+
 # new election command
 @discord.app_commands.command(
 	name = "start",
@@ -35,32 +54,36 @@ async def start_election(interaction: discord.Interaction, seats: int, title: st
 	}
 	
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-			if owner == user.mention:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' already exists in this channel. "
-					f"Create an election with a different title or delete it with `/delete {title}`",
-					ephemeral = True,
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' already exists in this channel. "
-					f"Create an election with a different title or ask its owner ({owner}) to delete it.",
-					ephemeral = True,
-				)
+		if owner == user.mention:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' already exists in this channel. "
+				f"Create an election with a different title or delete it with `/delete {title}`",
+				ephemeral = True,
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' already exists in this channel. "
+				f"Create an election with a different title or ask its owner ({owner}) to delete it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
 		# that's a good thing!
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-			print(json.dumps(data), file=file)
+		await elections.save(f"{guild.id}_{channel.id}_{title}", data)
 
 		return await interaction.response.send_message(
 			f"{user.mention} created a new election titled '{title}', with {seats} seat{'s' if seats != 1 else ''}. "
 			f"You can apply to run in this election with `/run {title}`!",
 		)
 
+# reply to an interaction, following up instead if it was deferred while work ran
+async def respond(interaction: discord.Interaction, *args, **kwargs):
+	if interaction.response.is_done():
+		return await interaction.followup.send(*args, **kwargs)
+	return await interaction.response.send_message(*args, **kwargs)
+
 # delete election command
 @discord.app_commands.command(
 	name = "delete",
@@ -72,31 +95,25 @@ async def delete_election(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
-
-			if owner == user.mention:
-				os.remove(f"elections/{guild.id}_{channel.id}_{title}.json")
-				try:
-					os.remove(f"elections/votes/{guild.id}_{channel.id}_{title}")
-				except FileNotFoundError:
-					pass
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-				# remove this election from views
-				with open(f"elections/views.json", "w") as file:
-					views.pop(f"{guild.id}_{channel.id}_{title}", None)
-					print(json.dumps(views), file=file)
+		if owner == user.mention:
+			# this removes its ballots too
+			await elections.delete(f"{guild.id}_{channel.id}_{title}")
+			votes.invalidate(f"{guild.id}_{channel.id}_{title}")
+			last_counts.pop(f"{guild.id}_{channel.id}_{title}", None)
+			standings.invalidate(f"{guild.id}_{channel.id}_{title}")
 
-				return await interaction.response.send_message(
-					f"{user.mention} deleted election with title '{title}'.",
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to delete it.",
-					ephemeral = True,
-				)
+			return await interaction.response.send_message(
+				f"{user.mention} deleted election with title '{title}'.",
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to delete it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
 		return await interaction.response.send_message(
 			f"An election with title '{title}' does not exist in this channel.",
@@ -117,35 +134,33 @@ async def join_election_function(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			
-			if data["status"] == "open":
-				return await interaction.response.send_message(
-					f"You cannot join the '{title}' election, because it is already open to votes.",
-					ephemeral = True,
-				)
-			elif data["status"] == "closed":
-				return await interaction.response.send_message(
-					f"You cannot join the '{title}' election, because it has already concluded.",
-					ephemeral = True,
-				)
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		
+		if data["status"] == "open":
+			return await interaction.response.send_message(
+				f"You cannot join the '{title}' election, because it is already open to votes.",
+				ephemeral = True,
+			)
+		elif data["status"] == "closed":
+			return await interaction.response.send_message(
+				f"You cannot join the '{title}' election, because it has already concluded.",
+				ephemeral = True,
+			)
 
-			if user.name in data["candidates"]:
-				return await interaction.response.send_message(
-					f"You are already participating in the '{title}' election.",
-					ephemeral = True,
-				)
-			else:
-				data["candidates"].append(user.name)
-				with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-					print(json.dumps(data), file=file)
+		if user.name in data["candidates"]:
+			return await interaction.response.send_message(
+				f"You are already participating in the '{title}' election.",
+				ephemeral = True,
+			)
+		else:
+			data["candidates"].append(user.name)
+			await elections.save(f"{guild.id}_{channel.id}_{title}", data)
 
-				return await interaction.response.send_message(
-					f"{user.mention} is now running in the '{title}' election! "
-					f"You can view all candidates with `/view {title}`. "
-					f"You can stop running in the election with `/withdraw {title}`.",
-				)
+			return await interaction.response.send_message(
+				f"{user.mention} is now running in the '{title}' election! "
+				f"You can view all candidates with `/view {title}`. "
+				f"You can stop running in the election with `/withdraw {title}`.",
+			)
 
 	except FileNotFoundError:
 		return await interaction.response.send_message(
@@ -167,34 +182,32 @@ async def leave_election_function(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			
-			if data["status"] == "open":
-				return await interaction.response.send_message(
-					f"You cannot leave the '{title}' election, because it is already open to votes.",
-					ephemeral = True,
-				)
-			elif data["status"] == "closed":
-				return await interaction.response.send_message(
-					f"You cannot leave the '{title}' election, because it has already concluded.",
-					ephemeral = True,
-				)
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		
+		if data["status"] == "open":
+			return await interaction.response.send_message(
+				f"You cannot leave the '{title}' election, because it is already open to votes.",
+				ephemeral = True,
+			)
+		elif data["status"] == "closed":
+			return await interaction.response.send_message(
+				f"You cannot leave the '{title}' election, because it has already concluded.",
+				ephemeral = True,
+			)
 
-			if user.name not in data["candidates"]:
-				return await interaction.response.send_message(
-					f"You are already not participating in the '{title}' election.",
-					ephemeral = True,
-				)
-			else:
-				data["candidates"].remove(user.name)
-				with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-					print(json.dumps(data), file=file)
+		if user.name not in data["candidates"]:
+			return await interaction.response.send_message(
+				f"You are already not participating in the '{title}' election.",
+				ephemeral = True,
+			)
+		else:
+			data["candidates"].remove(user.name)
+			await elections.save(f"{guild.id}_{channel.id}_{title}", data)
 
-				return await interaction.response.send_message(
-					f"{user.mention} has withdrawn from the '{title}' election! "
-					f"You can view all candidates with `/view {title}`.",
-				)
+			return await interaction.response.send_message(
+				f"{user.mention} has withdrawn from the '{title}' election! "
+				f"You can view all candidates with `/view {title}`.",
+			)
 
 	except FileNotFoundError:
 		return await interaction.response.send_message(
@@ -213,49 +226,47 @@ async def remove_from_election(interaction: discord.Interaction, title: str, mem
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
-			candidates = data["candidates"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
+		candidates = data["candidates"]
+
+		if data["status"] == "open":
+			return await interaction.response.send_message(
+				f"You cannot remove ({user.mention}) from the '{title}' election, because it is already open to votes.",
+				ephemeral = True,
+			)
+		elif data["status"] == "closed":
+			return await interaction.response.send_message(
+				f"You cannot remove ({user.mention}) from the '{title}' election, because has already concluded.",
+				ephemeral = True,
+			)
 
-			if data["status"] == "open":
+		if owner == user.mention:
+			if member.name not in candidates:
 				return await interaction.response.send_message(
-					f"You cannot remove ({user.mention}) from the '{title}' election, because it is already open to votes.",
+					f"{member.mention} is already not participating in the '{title}' election.",
 					ephemeral = True,
 				)
-			elif data["status"] == "closed":
+			else:
+				data["candidates"].remove(member.name)
+				await elections.save(f"{guild.id}_{channel.id}_{title}", data)
+
+				return await interaction.response.send_message(
+					f"{user.mention} removed {member.mention} from election with title '{title}'.",
+				)
+		else:
+			if member == user:
 				return await interaction.response.send_message(
-					f"You cannot remove ({user.mention}) from the '{title}' election, because has already concluded.",
+					f"Election with title '{title}' was created by a different user ({owner}). "
+					f"If you want to leave it, you can use `/withdraw {title}` instead.",
 					ephemeral = True,
 				)
-
-			if owner == user.mention:
-				if member.name not in candidates:
-					return await interaction.response.send_message(
-						f"{member.mention} is already not participating in the '{title}' election.",
-						ephemeral = True,
-					)
-				else:
-					data["candidates"].remove(member.name)
-					with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-						print(json.dumps(data), file=file)
-
-					return await interaction.response.send_message(
-						f"{user.mention} removed {member.mention} from election with title '{title}'.",
-					)
 			else:
-				if member == user:
-					return await interaction.response.send_message(
-						f"Election with title '{title}' was created by a different user ({owner}). "
-						f"If you want to leave it, you can use `/withdraw {title}` instead.",
-						ephemeral = True,
-					)
-				else:
-					return await interaction.response.send_message(
-						f"Election with title '{title}' was created by a different user. "
-						f"Ask its owner ({owner}) to remove a member.",
-						ephemeral = True,
-					)
+				return await interaction.response.send_message(
+					f"Election with title '{title}' was created by a different user. "
+					f"Ask its owner ({owner}) to remove a member.",
+					ephemeral = True,
+				)
 	except FileNotFoundError:
 		return await interaction.response.send_message(
 			f"An election with title '{title}' does not exist in this channel.",
@@ -273,17 +284,16 @@ async def view_election(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			seats = data["seats"]
-			candidates = data["candidates"]
-			if candidates == []:
-				candidates = ["no candidates!"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		seats = data["seats"]
+		candidates = data["candidates"]
+		if candidates == []:
+			candidates = ["no candidates!"]
 
-			return await interaction.response.send_message(
-				f"Registered candidates for election **{title}** ({seats} seat{'s' if seats != 1 else ''}):\n"
-				+ "\n".join([f"- {candidate}" for candidate in candidates])
-			)
+		return await interaction.response.send_message(
+			f"Registered candidates for election **{title}** ({seats} seat{'s' if seats != 1 else ''}):\n"
+			+ "\n".join([f"- {candidate}" for candidate in candidates])
+		)
 
 	except FileNotFoundError:
 		return await interaction.response.send_message(
@@ -291,8 +301,55 @@ async def view_election(interaction: discord.Interaction, title: str):
 			ephemeral = True
 		)
 
+# list elections in this channel
+@discord.app_commands.command(
+	name = "list",
+	description = "List all elections in this channel.",
+)
+async def list_elections(interaction: discord.Interaction):
+	guild = interaction.guild
+	channel = interaction.channel
+
+	found = await elections.find(guild.id, channel.id)
+	if found == []:
+		return await interaction.response.send_message(
+			f"There are no elections in this channel. You can start one with `/start`.",
+			ephemeral = True,
+		)
+
+	return await interaction.response.send_message(
+		f"Elections in this channel:\n"
+		+ "\n".join([f"- **{data['title']}** ({data['status']})" for data in found]),
+		ephemeral = True,
+	)
+
 from election import SingleTransferableVote
 
+# live election objects for elections that are being voted in
+votes = ElectionCache(store.load_votes)
+
+# finished ballots are written to the store in batches, one writer per election
+ballots = BallotWriter(store)
+
+# state of the last count of recently counted elections, so evaluating again after a reopen starts warm
+last_counts = OrderedDict()
+last_counts_size = 64
+
+def remember_count(election_id: str, last_count: dict):
+	# whichever election was counted longest ago is forgotten first
+	last_counts.pop(election_id, None)
+	last_counts[election_id] = last_count
+	while len(last_counts) > last_counts_size:
+		last_counts.popitem(last=False)
+
+async def provisional_count(election_id: str, election: SingleTransferableVote):
+	result = await run_count(election, last_counts.get(election_id))
+	remember_count(election_id, election.last_count)
+	return result
+
+# provisional results of open elections, recounted in the background now and then
+standings = Standings(provisional_count)
+
 # open election for voting
 @discord.app_commands.command(
 	name = "open",
@@ -304,45 +361,59 @@ async def open_election(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-			candidates = data["candidates"]
-			seats = data["seats"]
+		candidates = data["candidates"]
+		seats = data["seats"]
 
-			if data["status"] == "open":
+		if data["status"] == "open":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' is already open.",
+				ephemeral = True,
+			)
+
+		if owner == user.mention:
+			if len(candidates) < seats:
 				return await interaction.response.send_message(
-					f"Election with title '{title}' is already open.",
+					f"Election with title '{title}' cannot be opened, "
+					f"because it does not have enough candidates ({len(candidates)}) to fill all seats ({seats}). "
+					f"Wait until more people join or create an election with fewer seats.",
 					ephemeral = True,
 				)
-
-			if owner == user.mention:
-				if len(candidates) < seats:
-					return await interaction.response.send_message(
-						f"Election with title '{title}' cannot be opened, "
-						f"because it does not have enough candidates ({len(candidates)}) to fill all seats ({seats}). "
-						f"Wait until more people join or create an election with fewer seats.",
-						ephemeral = True,
-					)
-				else:
-					data["status"] = "open"
-					with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-						print(json.dumps(data), file=file)
-
-					election = SingleTransferableVote(seats, list(map(str, candidates)))
-					election.save(f"elections/votes/{guild.id}_{channel.id}_{title}")
-
-					return await interaction.response.send_message(
-						f"Election '{title}' is now accepting votes! "
-						f"You can vote in this election with `/vote {title}`.",
-					)
 			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to open it.",
-					ephemeral = True,
+				# reopening loads every ballot cast so far, which can outlast the interaction deadline
+				await interaction.response.defer(thinking = True)
+
+				reopened = data["status"] != "new"
+				data["status"] = "open"
+				await elections.save(f"{guild.id}_{channel.id}_{title}", data)
+
+				# reopening keeps the ballots cast so far, unless the candidates changed in the meantime
+				election = None
+				if reopened:
+					try:
+						election = await votes.get(f"{guild.id}_{channel.id}_{title}")
+					except FileNotFoundError:
+						pass
+				if election is None or election.candidates != set(map(str, candidates)) or election.seats != seats:
+					election = SingleTransferableVote(seats, list(map(str, candidates)))
+					await run_ballot_io(f"{guild.id}_{channel.id}_{title}", store.save_votes, f"{guild.id}_{channel.id}_{title}", election)
+					votes.invalidate(f"{guild.id}_{channel.id}_{title}")
+					last_counts.pop(f"{guild.id}_{channel.id}_{title}", None)
+					standings.invalidate(f"{guild.id}_{channel.id}_{title}")
+
+				return await respond(
+					interaction,
+					f"Election '{title}' is now accepting votes! "
+					f"You can vote in this election with `/vote {title}`.",
 				)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to open it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
 		return await interaction.response.send_message(
 			f"An election with title '{title}' does not exist in this channel.",
@@ -360,38 +431,46 @@ async def close_election(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-			if data["status"] == "new":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' has not yet opened.",
-					ephemeral = True,
-				)
-			elif data["status"] == "closed":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' is already closed.",
-					ephemeral = True,
-				)
+		if data["status"] == "new":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has not yet opened.",
+				ephemeral = True,
+			)
+		elif data["status"] == "closed":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' is already closed.",
+				ephemeral = True,
+			)
 
-			if owner == user.mention:
-				data["status"] = "closed"
-				with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-					print(json.dumps(data), file=file)
+		if owner == user.mention:
+			# folding up a large journal takes a while, don't miss the interaction deadline
+			await interaction.response.defer(thinking = True)
 
-				return await interaction.response.send_message(
-					f"Election '{title}' is no longer accepting votes. "
-					f"Its owner ({owner}) can evaluate the results with `/evaluate {title}`.",
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to close it.",
-					ephemeral = True,
-				)
+			data["status"] = "closed"
+			await elections.save(f"{guild.id}_{channel.id}_{title}", data)
+			# ballots still waiting for their batch must be in the journal before it is folded up
+			await ballots.flush_pending(f"{guild.id}_{channel.id}_{title}")
+			votes.invalidate(f"{guild.id}_{channel.id}_{title}")
+			# fold all journaled ballots into one place, so evaluating can load them in one go
+			await run_ballot_io(f"{guild.id}_{channel.id}_{title}", store.compact_votes, f"{guild.id}_{channel.id}_{title}")
+
+			return await respond(
+				interaction,
+				f"Election '{title}' is no longer accepting votes. "
+				f"Its owner ({owner}) can evaluate the results with `/evaluate {title}`.",
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to close it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
-		return await interaction.response.send_message(
+		return await respond(
+			interaction,
 			f"An election with title '{title}' does not exist in this channel.",
 			ephemeral = True
 		)
@@ -402,7 +481,7 @@ async def close_election(interaction: discord.Interaction, title: str):
 	description = "Submit a vote to the election named <title>.",
 )
 async def vote_in_election(interaction: discord.Interaction, title: str):
-	return await vote_in_election(interaction, title)
+	return await vote_in_election_function(interaction, title)
 
 async def vote_in_election_function(interaction: discord.Interaction, title: str):
 	guild = interaction.guild
@@ -410,32 +489,154 @@ async def vote_in_election_function(interaction: discord.Interaction, title: str
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-			if data["status"] == "new":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' has not opened yet. "
-					f"Its owner ({owner}) can open it with `/open {title}`.",
-					ephemeral = True,
-				)
-			elif data["status"] == "closed":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' has already closed. "
-					f"You can ask its owner ({owner}) to reopen it with `/open {title}`.",
-					ephemeral = True,
-				)
+		if data["status"] == "new":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has not opened yet. "
+				f"Its owner ({owner}) can open it with `/open {title}`.",
+				ephemeral = True,
+			)
+		elif data["status"] == "closed":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has already closed. "
+				f"You can ask its owner ({owner}) to reopen it with `/open {title}`.",
+				ephemeral = True,
+			)
+
+		async def save(election: SingleTransferableVote):
+			await ballots.commit(f"{guild.id}_{channel.id}_{title}", election, user.id)
+			standings.ballot_cast(f"{guild.id}_{channel.id}_{title}")
+
+		# the whole ranking in one form: the list of candidates, the form and submitting it are the only round trips
+		form = ballot_form(tuple(sorted(map(str, data["candidates"]))))
+		if form.fits_form():
+			async def submit(interaction: discord.Interaction, ranking: list[str]):
+				try:
+					# the election could have closed while the form was open
+					if (await elections.get(f"{guild.id}_{channel.id}_{title}"))["status"] != "open":
+						return await interaction.response.send_message(
+							f"Election with title '{title}' is no longer open, your vote was not recorded.",
+							ephemeral = True,
+						)
+
+					if f"{guild.id}_{channel.id}_{title}" not in votes:
+						await interaction.response.defer(ephemeral = True, thinking = True)
+					election = await votes.get(f"{guild.id}_{channel.id}_{title}")
+					election.Vote.from_list(ranking, user.id)
+				except FileNotFoundError:
+					return await respond(
+						interaction,
+						f"An election with title '{title}' does not exist in this channel.",
+						ephemeral = True
+					)
+				except ValueError:
+					return await respond(
+						interaction,
+						f"The candidates of election '{title}' changed while you were voting, please vote again.",
+						ephemeral = True,
+					)
+
+				await respond(interaction, f"Thank you! Your vote has been recorded.", ephemeral = True)
+				await save(election)
 
-			election = SingleTransferableVote.load(f"elections/votes/{guild.id}_{channel.id}_{title}")
-			return await cast_vote(
+			async def open_form(interaction: discord.Interaction):
+				await interaction.response.send_modal(RankingModal(form, title, submit))
+
+			button = discord.ui.Button(label = "Rank the candidates", style = discord.ButtonStyle.primary)
+			button.callback = open_form
+			view = discord.ui.View(timeout = 15 * 60)
+			view.add_item(button)
+			return await interaction.response.send_message(
+				embed = discord.Embed(title = f"Candidates in {title}"[:256], description = form.listing),
+				view = view,
+				ephemeral = True,
+			)
+
+		# too many candidates to list in a form, pick them one at a time instead.
+		# loading every ballot cast so far can take a while, don't miss the interaction deadline
+		if f"{guild.id}_{channel.id}_{title}" not in votes:
+			await interaction.response.defer(ephemeral = True, thinking = True)
+
+		election = await votes.get(f"{guild.id}_{channel.id}_{title}")
+		return await cast_vote(interaction, election, save=functools.partial(save, election))
+
+	except FileNotFoundError:
+		return await respond(
+			interaction,
+			f"An election with title '{title}' does not exist in this channel.",
+			ephemeral = True
+		)
+
+# provisional results
+@discord.app_commands.command(
+	name = "standings",
+	description = "See who would be elected in the election named <title> if voting closed now.",
+)
+async def election_standings(interaction: discord.Interaction, title: str):
+	guild = interaction.guild
+	channel = interaction.channel
+	user = interaction.user
+
+	try:
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
+
+		if data["status"] == "new":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has not opened yet.",
+				ephemeral = True,
+			)
+		elif data["status"] == "evaluated":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has already been evaluated.",
+				ephemeral = True,
+			)
+
+		# only the owner gets to see results while voting is still going on
+		if owner != user.mention:
+			return await interaction.response.send_message(
+				f"Only the owner of election '{title}' ({owner}) can see its standings.",
+				ephemeral = True,
+			)
+
+		if f"{guild.id}_{channel.id}_{title}" not in votes:
+			await interaction.response.defer(ephemeral = True, thinking = True)
+		election = await votes.get(f"{guild.id}_{channel.id}_{title}")
+
+		if len(election.votes) == 0:
+			return await respond(
 				interaction,
-				election,
-				save=lambda: election.save(f"elections/votes/{guild.id}_{channel.id}_{title}"),
+				f"No votes have been cast in election '{title}' yet.",
+				ephemeral = True,
 			)
 
+		result = standings.get(f"{guild.id}_{channel.id}_{title}", election)
+		if result is None:
+			return await respond(
+				interaction,
+				f"The votes in election '{title}' are being counted, check again in a moment.",
+				ephemeral = True,
+			)
+
+		counted = f"after {result['ballots']} vote{'s' if result['ballots'] != 1 else ''}"
+		if "error" in result:
+			return await respond(
+				interaction,
+				f"The provisional count of election '{title}' {counted} failed with {result['error']}.",
+				ephemeral = True,
+			)
+		return await respond(
+			interaction,
+			f"Provisionally elected in election **{title}** {counted}:\n"
+			+ "\n".join([f"- {candidate}" for candidate in result["elected"]])
+			+ "\n\nThis can still change until the election is evaluated.",
+			ephemeral = True,
+		)
 	except FileNotFoundError:
-		return await interaction.response.send_message(
+		return await respond(
+			interaction,
 			f"An election with title '{title}' does not exist in this channel.",
 			ephemeral = True
 		)
@@ -451,51 +652,63 @@ async def evaluate_election(interaction: discord.Interaction, title: str):
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
-			seats = data["seats"]
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
+		seats = data["seats"]
 
-			if data["status"] == "new":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' has not yet opened.",
-					ephemeral = True,
-				)
-			elif data["status"] == "open":
-				return await interaction.response.send_message(
-					f"Election with title '{title}' has not yet closed.",
-					ephemeral = True,
-				)
-
-			if owner == user.mention:
-				data["status"] = "evaluated"
-				with open(f"elections/{guild.id}_{channel.id}_{title}.json", "w") as file:
-					print(json.dumps(data), file=file)
-
-				election = SingleTransferableVote.load(f"elections/votes/{guild.id}_{channel.id}_{title}")
-				result = election.run()
-				votes = election.get_votes()
+		if data["status"] == "new":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has not yet opened.",
+				ephemeral = True,
+			)
+		elif data["status"] == "open":
+			return await interaction.response.send_message(
+				f"Election with title '{title}' has not yet closed.",
+				ephemeral = True,
+			)
 
-				return await interaction.response.send_message(
-					f"Elected in election **{title}** ({seats} seat{'s' if seats != 1 else ''}):\n"
-					+ "\n".join([f"- {candidate}" for candidate in result])
-					+ "\n\n"
-					+ f"Cast votes:\n"
-					+ "\n".join([f"{i+1}. " + ", ".join(votes[i]) for i in range(len(votes))]),
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to evaluate it.",
-					ephemeral = True,
-				)
+		if owner == user.mention:
+			# counting can take a while, keep the bot responsive until it is done
+			await interaction.response.defer(thinking = True)
+
+			data["status"] = "evaluated"
+			await elections.save(f"{guild.id}_{channel.id}_{title}", data)
+
+			await ballots.flush_pending(f"{guild.id}_{channel.id}_{title}")
+			election = await votes.get(f"{guild.id}_{channel.id}_{title}")
+			trace = Trace()
+			result = await run_count(election, last_counts.get(f"{guild.id}_{channel.id}_{title}"), trace)
+			remember_count(f"{guild.id}_{channel.id}_{title}", election.last_count)
+			# standings are not shown once an election is evaluated
+			standings.invalidate(f"{guild.id}_{channel.id}_{title}")
+
+			# every ballot and the count round by round go in an attachment, the message stays short
+			elected = sorted(result)
+			results = await run_export(election, elected, trace)
+			cast = len(election.votes)
+
+			return await interaction.followup.send(
+				f"Elected in election **{title}** ({seats} seat{'s' if seats != 1 else ''}):\n"
+				+ "\n".join([f"- {candidate}" for candidate in elected])
+				+ "\n\n"
+				+ f"{cast} vote{'s' if cast != 1 else ''} cast. The attached results hold every ballot and the count round by round.",
+				file = discord.File(results, filename = f"{title} results.zip"),
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to evaluate it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
-		return await interaction.response.send_message(
+		return await respond(
+			interaction,
 			f"An election with title '{title}' does not exist in this channel.",
 			ephemeral = True
 		)
 	except AssertionError as assertion:
-		return await interaction.response.send_message(
+		return await respond(
+			interaction,
 			f"The evaluation for election '{title}' failed with {assertion}.",
 		)
 
@@ -510,34 +723,24 @@ async def join_election_persistent(interaction: discord.Interaction, title: str)
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
-
-			if owner == user.mention:
-				election_id = f"{guild.id}_{channel.id}_{title}"
-				view_id = "run"
-				view = persistent_view(election_id, view_id, title)
-				
-				# add this view to views if not added yet
-				with open(f"elections/views.json", "w") as file:
-					election = views.get(election_id, {"title": title, "views": []})
-					if view_id not in election["views"]:
-						election["views"].append(view_id)
-					views[election_id] = election
-
-					print(json.dumps(views), file=file)
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-				return await interaction.response.send_message(
-					f"Press this button to run in the election with title '{title}'!",
-					view = view,
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to create a persistent run button for it.",
-					ephemeral = True,
-				)
+		if owner == user.mention:
+			election_id = f"{guild.id}_{channel.id}_{title}"
+			view_id = "run"
+			view = persistent_view(election_id, view_id)
+
+			return await interaction.response.send_message(
+				f"Press this button to run in the election with title '{title}'!",
+				view = view,
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to create a persistent run button for it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
 		return await interaction.response.send_message(
 			f"An election with title '{title}' does not exist in this channel.",
@@ -555,34 +758,24 @@ async def vote_in_election_persistent(interaction: discord.Interaction, title: s
 	user = interaction.user
 
 	try:
-		with open(f"elections/{guild.id}_{channel.id}_{title}.json", "r") as file:
-			data = json.loads(file.read())
-			owner = data["user"]
-
-			if owner == user.mention:
-				election_id = f"{guild.id}_{channel.id}_{title}"
-				view_id = "vote"
-				view = persistent_view(election_id, view_id, title)
-				
-				# add this view to views if not added yet
-				with open(f"elections/views.json", "w") as file:
-					election = views.get(election_id, {"title": title, "views": []})
-					if view_id not in election["views"]:
-						election["views"].append(view_id)
-					views[election_id] = election
-
-					print(json.dumps(views), file=file)
+		data = await elections.get(f"{guild.id}_{channel.id}_{title}")
+		owner = data["user"]
 
-				return await interaction.response.send_message(
-					f"Press this button to vote in the election with title '{title}'!",
-					view = view,
-				)
-			else:
-				return await interaction.response.send_message(
-					f"Election with title '{title}' was created by a different user. "
-					f"Ask its owner ({owner}) to create a persistent vote button for it.",
-					ephemeral = True,
-				)
+		if owner == user.mention:
+			election_id = f"{guild.id}_{channel.id}_{title}"
+			view_id = "vote"
+			view = persistent_view(election_id, view_id)
+
+			return await interaction.response.send_message(
+				f"Press this button to vote in the election with title '{title}'!",
+				view = view,
+			)
+		else:
+			return await interaction.response.send_message(
+				f"Election with title '{title}' was created by a different user. "
+				f"Ask its owner ({owner}) to create a persistent vote button for it.",
+				ephemeral = True,
+			)
 	except FileNotFoundError:
 		return await interaction.response.send_message(
 			f"An election with title '{title}' does not exist in this channel.",
@@ -590,12 +783,107 @@ async def vote_in_election_persistent(interaction: discord.Interaction, title: s
 		)
 
 dont_care = "I do not care about the order of the rest of the ballot"
-async def cast_vote(interaction: discord.Interaction, election: SingleTransferableVote, save=lambda: None):
-	selection = discord.ui.Select()
+async def no_save():
+	pass
+
+class BallotForm:
+	# everything the ballot menus of one set of candidates need, built once and shared by every voter
+	def __init__(self, candidates: tuple[str]):
+		self.candidates = sorted(candidates)
+		self.names = {candidate.casefold(): candidate for candidate in self.candidates}
+		# discord caps select option labels and values at 100 characters
+		self.options = {candidate: discord.SelectOption(label = candidate[:100], value = candidate[:100]) for candidate in self.candidates}
+		self.values = {candidate[:100]: candidate for candidate in self.candidates}
+		self.dont_care = discord.SelectOption(label = dont_care)
+
+		# numbered list of everyone, shown next to the ranking form but never put in it,
+		# so submitting the form untouched can't cast a ballot in alphabetical order
+		self.listing = "\n".join([f"{i+1}. {candidate}" for i, candidate in enumerate(self.candidates)])
+
+	def fits_form(self):
+		# a form text field holds at most 4000 characters, and the listing goes in an embed of at most 4096
+		return len(self.listing) <= 4000
+
+	def parse(self, text: str):
+		# one candidate per line or comma, by name or by their number on the form
+		ranking = []
+		for item in re.split(r"[\n,]", text):
+			item = item.strip()
+			if item == "":
+				continue
+
+			number, name = re.fullmatch(r"(?:(\d+)[.)]?\s*)?(.*)", item).groups()
+			if item.casefold() in self.names:
+				candidate = self.names[item.casefold()]
+			elif name.casefold() in self.names:
+				candidate = self.names[name.casefold()]
+			elif name == "" and 1 <= int(number) <= len(self.candidates):
+				candidate = self.candidates[int(number) - 1]
+			else:
+				raise ValueError(f"'{item}' is not one of the candidates.")
+
+			if candidate in ranking:
+				raise ValueError(f"{candidate} is ranked more than once.")
+			ranking.append(candidate)
+		return ranking
+
+	def pages(self, remaining: set[str]):
+		# up to four menus of 25 options on each page, the last row is kept free for page buttons
+		options = [self.options[candidate] for candidate in self.candidates if candidate in remaining] + [self.dont_care]
+		menus = [options[i:i + 25] for i in range(0, len(options), 25)]
+		return [menus[i:i + 4] for i in range(0, len(menus), 4)]
+
+@functools.lru_cache(maxsize = 128)
+def ballot_form(candidates: tuple[str]):
+	return BallotForm(candidates)
+
+class RankingModal(discord.ui.Modal):
+	def __init__(self, form: BallotForm, title: str, submit):
+		super().__init__(title = f"Vote in {title}"[:45])
+		self.form = form
+		# submit(interaction, ranking) records a parsed ranking
+		self.submit = submit
+		self.ranking = discord.ui.TextInput(
+			label = "Your ranking, favourite first",
+			style = discord.TextStyle.paragraph,
+			placeholder = "Names or numbers from the list, one per line or separated by commas",
+			max_length = 4000,
+		)
+		self.add_item(self.ranking)
 
-	print("casting vote")
+	async def on_submit(self, interaction: discord.Interaction):
+		try:
+			ranking = self.form.parse(self.ranking.value)
+		except ValueError as error:
+			return await interaction.response.send_message(
+				f"{error} Your vote was not recorded, please vote again.",
+				ephemeral = True,
+			)
+		await self.submit(interaction, ranking)
 
+async def cast_vote(interaction: discord.Interaction, election: SingleTransferableVote, save=no_save):
+	form = ballot_form(tuple(sorted(election.candidates)))
 	vote = election.Vote(interaction.user.id)
+	page = 0
+
+	# menus for the current page of candidates still to rank
+	def menu():
+		nonlocal page
+		pages = form.pages(vote.choices())
+		page = min(page, len(pages) - 1)
+
+		view = discord.ui.View()
+		for options in pages[page]:
+			selection = discord.ui.Select(options = options, placeholder = f"{options[0].label[:60]} to {options[-1].label[:60]}")
+			selection.callback = lambda interaction, selection = selection: next_round(interaction, selection.values[0])
+			view.add_item(selection)
+
+		if len(pages) > 1:
+			for label, step in [("Previous candidates", -1), ("More candidates", 1)]:
+				button = discord.ui.Button(label = label, disabled = not 0 <= page + step < len(pages), row = 4)
+				button.callback = lambda interaction, step = step: turn_page(interaction, step)
+				view.add_item(button)
+		return view
 
 	# respond to a selection from these candidates
 	async def next_round(interaction: discord.Interaction, submit: str = None):
@@ -605,87 +893,86 @@ async def cast_vote(interaction: discord.Interaction, election: SingleTransferab
 			vote.submit(None)
 			candidates = set()
 		else:
-			vote.submit(submit)
+			vote.submit(form.values[submit])
 			candidates = vote.choices()
 
-
 		if len(candidates) > 1:
-			# if there is a choice, create options
-			selection.options = [
-				discord.SelectOption(label = candidate)
-				if candidate is not None
-				else discord.SelectOption(label = dont_care)
-				for candidate in candidates
-			]
-
-			# run next selection round
-			await interaction.response.send_message(
-				f"Please pick your favourite out of the following candidates:",
-				view = discord.ui.View().add_item(selection),
-				ephemeral=True,
-			)
+			# later rounds update the same message instead of sending a new one
+			content = f"Please pick your favourite out of the following candidates:"
+			if submit is None:
+				await respond(interaction, content, view = menu(), ephemeral = True)
+			else:
+				await interaction.response.edit_message(content = content, view = menu())
 		else:
 			# no choice, vote ends
 			if len(candidates) == 1:
 				for candidate in candidates:
 					vote.submit(candidate)
 
-			await interaction.response.send_message(
-				f"Thank you! Your vote has been recorded.",
-				ephemeral=True,
-			)
+			content = f"Thank you! Your vote has been recorded."
+			if submit is None:
+				await respond(interaction, content, ephemeral = True)
+			else:
+				await interaction.response.edit_message(content = content, view = None)
 
-			save()
+			await save()
 
-	# after each round do these three things in order
-	selection.callback = lambda interaction: next_round(
-		interaction,
-		submit = selection.values[0],
-	)
+	async def turn_page(interaction: discord.Interaction, step: int):
+		nonlocal page
+		page += step
+		await interaction.response.edit_message(view = menu())
 
 	# run first round with all candidates
 	await next_round(interaction)
 
-# define persistent views
-def persistent_view(election_id: str, view_id: str, title: str):
-	class PersistentView(discord.ui.View):
-		def __init__(self):
-			super().__init__(timeout = None)
-
-		if view_id == "run":
-			@discord.ui.button(label="Run in this election", custom_id=f"{election_id}:run")
-			async def run(self, interaction: discord.Interaction, button: discord.ui.Button):
-				return await join_election_function(interaction, title)
-			
-			@discord.ui.button(label="Withdraw from this election", custom_id=f"{election_id}:withdraw")
-			async def withdraw(self, interaction: discord.Interaction, button: discord.ui.Button):
-				return await leave_election_function(interaction, title)
-		
-		elif view_id == "vote":
-			@discord.ui.button(label="Vote in this election", custom_id=f"{election_id}:vote")
-			async def vote(self, interaction: discord.Interaction, button: discord.ui.Button):
-				return await vote_in_election_function(interaction, title)
-		
-		elif view_id == "awawa":
-			@discord.ui.button(label="awawa", custom_id=f"{election_id}:awawa")
-			async def awawa(self, interaction: discord.Interaction, button: discord.ui.Button):
-				return await interaction.response.send_message("awawa", ephemeral=True)
-		
-	return PersistentView()
+# every persistent button is dispatched by this one class, its custom_id says what it does
+class ElectionButton(
+	discord.ui.DynamicItem[discord.ui.Button],
+	template = r"(?P<election_id>[0-9]+_[0-9]+_.*):(?P<action>run|withdraw|vote)",
+):
+	labels = {
+		"run": "Run in this election",
+		"withdraw": "Withdraw from this election",
+		"vote": "Vote in this election",
+	}
+
+	def __init__(self, election_id: str, action: str):
+		super().__init__(discord.ui.Button(label = self.labels[action], custom_id = f"{election_id}:{action}"))
+		self.election_id = election_id
+		self.action = action
 
-# get views list from views.json
-with open("elections/views.json", "r") as file:
-	views = json.loads(file.read())
+	@classmethod
+	async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+		return cls(match["election_id"], match["action"])
+
+	async def callback(self, interaction: discord.Interaction):
+		# election ids are "{guild}_{channel}_{title}", and the ids never contain underscores
+		title = self.election_id.split("_", 2)[2]
+
+		if self.action == "run":
+			return await join_election_function(interaction, title)
+		elif self.action == "withdraw":
+			return await leave_election_function(interaction, title)
+		elif self.action == "vote":
+			return await vote_in_election_function(interaction, title)
+
+# define persistent views
+def persistent_view(election_id: str, view_id: str):
+	view = discord.ui.View(timeout = None)
+	if view_id == "run":
+		view.add_item(ElectionButton(election_id, "run"))
+		view.add_item(ElectionButton(election_id, "withdraw"))
+	elif view_id == "vote":
+		view.add_item(ElectionButton(election_id, "vote"))
+	return view
 
 # log in and update commands
 @client.event
 async def on_ready():
 	print(f'Logged in as {client.user}')
 
-	# load views
-	for election_id in views:
-		for view_id in views[election_id]["views"]:
-			client.add_view(persistent_view(election_id, view_id, title = views[election_id]["title"]))
+	# handle all persistent buttons, whenever they were created
+	client.add_dynamic_items(ElectionButton)
 
 	tree = discord.app_commands.CommandTree(client)
 	tree.add_command(start_election, guild=None)
@@ -694,14 +981,18 @@ async def on_ready():
 	tree.add_command(leave_election, guild=None)
 	tree.add_command(remove_from_election, guild=None)
 	tree.add_command(view_election, guild=None)
+	tree.add_command(list_elections, guild=None)
 	tree.add_command(open_election, guild=None)
 	tree.add_command(close_election, guild=None)
 	tree.add_command(vote_in_election, guild=None)
+	tree.add_command(election_standings, guild=None)
 	tree.add_command(evaluate_election, guild=None)
 	tree.add_command(join_election_persistent, guild=None)
 	tree.add_command(vote_in_election_persistent, guild=None)
 	await tree.sync(guild=None)
 
-with open("token", "r") as file:
-	token = file.read()
-client.run(token)
\ No newline at end of file
+# counting processes import this module too, they must not start their own bot
+if __name__ == "__main__":
+	with open("token", "r") as file:
+		token = file.read()
+	client.run(token)
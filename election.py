@@ -1,10 +1,542 @@
+import csv
+import mmap
+import os
 import pickle
+import random
+import struct
+import time
+import zlib
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# ballot files start with this, anything else is an old pickled election
+MAGIC = b"STVB"
+VERSION = 1
+# magic, version, seats, candidates, ballots, ranked choices, bytes of the voter table
+HEADER = struct.Struct("<4sHIIQQQ")
+# ballot journals start with this, then every record is its length and crc32 followed by a pickled ballot
+JOURNAL = b"STVJ"
+RECORD = struct.Struct("<II")
+# ballot stores key voters by discord id, other voter names are numbered from NAMED up
+NAMED = 1 << 63
+REPLACED = (1 << 64) - 1
+
+class Tally:
+	# running aggregates over candidate ids, kept up to date as ballots come in
+	def __init__(self, candidates: int):
+		self.ballots = 0
+		# ranking -> number of voters who cast exactly that ranking
+		self.groups = Counter()
+		self.first = [0] * candidates
+		self.ranked = [0] * candidates
+		# pairs[a][b] is the number of ballots ranking both a and b, with a above b
+		self.pairs = [[0] * candidates for _ in range(candidates)]
+
+	def add(self, ranking: tuple[int], count: int = 1):
+		# a negative count takes ballots back out
+		self.ballots += count
+		self.groups[ranking] += count
+		if self.groups[ranking] == 0:
+			del self.groups[ranking]
+
+		if ranking:
+			self.first[ranking[0]] += count
+		for position, a in enumerate(ranking):
+			self.ranked[a] += count
+			for b in ranking[position + 1:]:
+				self.pairs[a][b] += count
+
+	def copy(self):
+		tally = Tally(0)
+		tally.ballots, tally.groups = self.ballots, self.groups.copy()
+		tally.first, tally.ranked = self.first.copy(), self.ranked.copy()
+		tally.pairs = [row.copy() for row in self.pairs]
+		return tally
+
+class BallotStore:
+	def __init__(self, candidates: list[str]):
+		# candidates are interned to small integer ids
+		self.names = sorted(candidates)
+		self.ids = {name: i for i, name in enumerate(self.names)}
+
+		# finished rankings packed back to back, ballot `slot` is rankings[offsets[slot]:offsets[slot + 1]]
+		self.rankings = array("H")
+		self.offsets = array("Q", [0])
+		# voter of every slot, REPLACED for ballots the voter cast again, slots of those are left behind until compacted
+		self._voters = array("Q")
+		# open addressing table of slots, found by hashing the voter
+		self.index = array("i", [-1]) * 8
+		self.shift = 61
+		self.live = 0
+		# voters that are not discord ids get numbers from NAMED up
+		self.named = {}
+		self.voter_names = []
+		# undecoded voter table of a memory-mapped ballot file
+		self.voter_table = None
+		# aggregates over the latest ballot of every voter, None until someone asks for them.
+		# the pairwise part is candidates squared, so stores only counted never pay for it
+		self.tally = None
+
+	@classmethod
+	def mapped(cls, names: list[str], rankings: memoryview, offsets: memoryview, voter_table: memoryview):
+		# a read-only store straight on top of a ballot file, nothing is copied until it is changed
+		store = cls(names)
+		store.rankings, store.offsets = rankings, offsets
+		store._voters, store.voter_table = None, voter_table
+		return store
+
+	@property
+	def voters(self):
+		# voters of a memory-mapped store are only decoded once someone asks for them
+		if self._voters is None:
+			self._voters = array("Q")
+			position = 0
+			for _ in range(len(self.offsets) - 1):
+				(length,) = struct.unpack_from("<H", self.voter_table, position)
+				self._voters.append(self.voter_key(bytes(self.voter_table[position + 2:position + 2 + length]).decode(), True))
+				position += 2 + length
+			self.voter_table = None
+			self.live = len(self._voters)
+			self.reindex()
+		return self._voters
+
+	def voter_key(self, user: str, add: bool = False):
+		# discord ids are kept as they are, anything else is numbered
+		if user.isdigit() and user.isascii() and (user[0] != "0" or user == "0"):
+			key = int(user)
+			if key < NAMED:
+				return key
+		if user not in self.named:
+			if not add:
+				return None
+			self.named[user] = NAMED + len(self.voter_names)
+			self.voter_names.append(user)
+		return self.named[user]
+
+	def voter_name(self, key: int):
+		return str(key) if key < NAMED else self.voter_names[key - NAMED]
+
+	def find(self, key: int):
+		# position of `key` in the index, or of the empty entry it would go in
+		voters, index = self._voters, self.index
+		mask = len(index) - 1
+		position = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self.shift
+		while index[position] >= 0 and voters[index[position]] != key:
+			position = (position + 1) & mask
+		return position
+
+	def reindex(self):
+		# a quarter full after rebuilding, rebuilt again once half full
+		size = 8
+		while size < 4 * self.live:
+			size *= 2
+		self.index = array("i", [-1]) * size
+		# fibonacci hashing, the top bits of the product pick the position
+		self.shift = 65 - size.bit_length()
+		for slot, key in enumerate(self._voters):
+			if key != REPLACED:
+				self.index[self.find(key)] = slot
+
+	def slot(self, user: str):
+		# decode first, named voters are only known after that
+		self.voters
+		key = self.voter_key(user)
+		slot = -1 if key is None else self.index[self.find(key)]
+		if slot < 0:
+			raise KeyError(user)
+		return slot
+
+	def __len__(self):
+		if self._voters is None:
+			return len(self.offsets) - 1
+		return self.live
+
+	def __contains__(self, user: str):
+		try:
+			self.slot(user)
+		except KeyError:
+			return False
+		return True
+
+	def __iter__(self):
+		for key in self.voters:
+			if key != REPLACED:
+				yield self.voter_name(key)
+
+	def __getitem__(self, user: str):
+		return [self.names[i] for i in self.ranking_ids(self.slot(user))]
+
+	def items(self):
+		for slot, key in enumerate(self.voters):
+			if key != REPLACED:
+				yield self.voter_name(key), [self.names[i] for i in self.ranking_ids(slot)]
+
+	def ranking_ids(self, slot: int):
+		return self.rankings[self.offsets[slot]:self.offsets[slot + 1]]
+
+	def live_slots(self):
+		# every slot of a memory-mapped or freshly compacted store is somebody's latest ballot
+		if len(self) == len(self.offsets) - 1:
+			return range(len(self))
+		return (slot for slot, key in enumerate(self.voters) if key != REPLACED)
+
+	def writable(self):
+		# copy a memory-mapped store into arrays before the first change
+		if isinstance(self.rankings, memoryview):
+			self.voters
+			self.rankings, self.offsets = array("H", self.rankings), array("Q", self.offsets)
+
+	def add(self, user: str, ranking: list[str]):
+		ids = tuple(self.ids[name] for name in ranking)
+		replaced = self.place(user, ids)
+		if self.tally is not None:
+			if replaced >= 0:
+				self.tally.add(tuple(self.ranking_ids(replaced)), -1)
+			self.tally.add(ids)
+
+		# drop replaced ballots once they make up most of the store
+		if 2 * len(self) < len(self.offsets) - 1:
+			self.compact()
+
+	def place(self, user: str, ids):
+		# store a ballot in a new slot without tallying it, returns the slot of the voter's earlier ballot or -1
+		self.writable()
+		key = self.voter_key(user, True)
+		position = self.find(key)
+		replaced = self.index[position]
+		if replaced >= 0:
+			self._voters[replaced] = REPLACED
+		else:
+			self.live += 1
+		self.index[position] = len(self.offsets) - 1
+		self._voters.append(key)
+		self.rankings.extend(ids)
+		self.offsets.append(len(self.rankings))
+
+		if 2 * self.live > len(self.index):
+			self.reindex()
+		return replaced
+
+	def compact(self):
+		if len(self) == len(self.offsets) - 1:
+			return
+
+		rankings, offsets, voters = array("H"), array("Q", [0]), array("Q")
+		for slot, key in enumerate(self.voters):
+			if key != REPLACED:
+				voters.append(key)
+				rankings.extend(self.ranking_ids(slot))
+				offsets.append(len(rankings))
+		self.rankings, self.offsets, self._voters = rankings, offsets, voters
+		self.reindex()
+
+	def copy(self):
+		store = BallotStore.__new__(BallotStore)
+		store.names, store.ids = self.names, self.ids
+		store.live, store.named, store.voter_names = self.live, self.named.copy(), self.voter_names.copy()
+		if isinstance(self.rankings, memoryview):
+			# memory-mapped rankings are never written to, so they can be shared
+			store.rankings, store.offsets = self.rankings, self.offsets
+		else:
+			store.rankings, store.offsets = array("H", self.rankings), array("Q", self.offsets)
+		store.voter_table = self.voter_table
+		store._voters = array("Q", self._voters) if self._voters is not None else None
+		store.index, store.shift = array("i", self.index), self.shift
+		store.tally = self.tally.copy() if self.tally is not None else None
+		return store
+
+	def to_bytes(self):
+		# voter table, offsets and rankings of a ballot file, slots must be in voter order
+		if self._voters is None:
+			voter_table = bytes(self.voter_table)
+		else:
+			self.compact()
+			voter_table = b"".join(
+				struct.pack("<H", len(key)) + key for key in (self.voter_name(voter).encode() for voter in self.voters)
+			)
+			# keep the offsets 8-byte aligned so they can be mapped without copying
+			voter_table += bytes(-len(voter_table) % 8)
+		return voter_table, bytes(self.offsets), bytes(self.rankings)
+
+	def tallied(self):
+		# ballots are tallied once, on first use, and kept up to date from then on
+		if self.tally is None:
+			tally = Tally(len(self.names))
+			for ranking, count in self.group_ids():
+				tally.add(ranking, count)
+			self.tally = tally
+		return self.tally
+
+	def grouped(self):
+		# turn the distinct rankings back into names, a tally already has them grouped
+		groups = self.tally.groups.items() if self.tally is not None else self.group_ids()
+		return [
+			(tuple(self.names[i] for i in ranking), count)
+			for ranking, count in groups
+			# empty ballots only count towards the quota, they never transfer weight
+			if ranking
+		]
+
+	def group_ids(self):
+		if numpy is not None:
+			return self.group_ids_numpy()
+
+		return list(Counter(tuple(self.ranking_ids(slot)) for slot in self.live_slots()).items())
+
+	def group_ids_numpy(self):
+		offsets = numpy.frombuffer(self.offsets, dtype=numpy.uint64).astype(numpy.int64)
+		rankings = numpy.frombuffer(self.rankings, dtype=numpy.uint16)
+		slots = numpy.fromiter(self.live_slots(), dtype=numpy.int64, count=len(self))
+		if len(slots) == 0:
+			return []
+
+		# lay the ballots out as padded rows and let numpy find the distinct ones
+		starts = offsets[slots]
+		lengths = offsets[slots + 1] - starts
+		width = max(int(lengths.max()), 1)
+		positions = numpy.arange(width)
+		filled = positions < lengths[:, None]
+		matrix = numpy.full((len(slots), width), 0xFFFF, dtype=numpy.uint16)
+		matrix[filled] = rankings[(starts[:, None] + positions)[filled]]
+
+		rows, counts = numpy.unique(matrix, axis=0, return_counts=True)
+		return [
+			(tuple(i for i in row if i != 0xFFFF), count)
+			for row, count in zip(rows.tolist(), counts.tolist())
+		]
+
+def float_totals(matrix, counts, keep):
+	# one counting pass over a preference matrix, `keep` has a trailing 0 for the padding index.
+	# eliminated candidates and padding keep nothing, so weight passes straight through them
+	keep_matrix = keep[matrix]
+
+	# weight still left on each ballot when it reaches each rank position
+	remaining = numpy.cumprod(1 - keep_matrix, axis=1)
+	remaining = numpy.hstack([numpy.ones((len(matrix), 1)), remaining[:, :-1]])
+
+	assigned = remaining * keep_matrix * counts[:, None]
+	return numpy.bincount(matrix.ravel(), weights=assigned.ravel(), minlength=len(keep))
+
+def fixed_totals(matrix, counts, keep, scale: int):
+	remaining = counts * scale
+	totals = numpy.zeros(len(keep), dtype=numpy.int64)
+
+	# walk the rank positions in turn, rounding exactly like `fixed_distribution`.
+	# remaining * keep // scale is split up so the product can't overflow.
+	for column in matrix.T:
+		keep_column = keep[column]
+		assigned = (remaining // scale) * keep_column + (remaining % scale) * keep_column // scale
+		remaining -= assigned
+		numpy.add.at(totals, column, assigned)
+	return totals
+
+class MatrixDistribution:
+	# counting passes over a preference matrix, `scale` is None for float counts
+	def __init__(self, order: list[str], index: dict, matrix, counts, scale: int = None):
+		self.order = order
+		self.index = index
+		self.matrix = matrix
+		self.counts = counts
+		self.scale = scale
+
+	def distribute(self, keep_values, candidates):
+		if self.scale is None:
+			keep = numpy.array([keep_values[candidate] for candidate in self.order] + [0], dtype=float)
+			totals = float_totals(self.matrix, self.counts, keep)
+			return {candidate: float(totals[self.index[candidate]]) for candidate in candidates}
+
+		keep = numpy.array([keep_values[candidate] for candidate in self.order] + [0], dtype=numpy.int64)
+		totals = fixed_totals(self.matrix, self.counts, keep, self.scale)
+		return {candidate: int(totals[self.index[candidate]]) for candidate in candidates}
+
+def share_ballots(matrix, counts):
+	# one shared memory block holding a preference matrix followed by its counts
+	memory = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes + counts.nbytes, 1))
+	numpy.ndarray(matrix.shape, dtype=numpy.intp, buffer=memory.buf)[:] = matrix
+	numpy.ndarray(counts.shape, dtype=counts.dtype, buffer=memory.buf, offset=matrix.nbytes)[:] = counts
+	return memory
+
+def attach_ballots(name: str, shape: tuple, dtype: str):
+	memory = shared_memory.SharedMemory(name)
+	matrix = numpy.ndarray(shape, dtype=numpy.intp, buffer=memory.buf)
+	counts = numpy.ndarray(shape[:1], dtype=dtype, buffer=memory.buf, offset=matrix.nbytes)
+	return memory, matrix, counts
+
+# the shared ballots of `Shards`, as seen from inside a pool process
+shard = None
+
+def attach_shard(name: str, shape: tuple, dtype: str, scale: int):
+	global shard
+	shard = (*attach_ballots(name, shape, dtype), scale)
+
+def shard_totals(start: int, stop: int, keep):
+	memory, matrix, counts, scale = shard
+	if scale is None:
+		return float_totals(matrix[start:stop], counts[start:stop], keep)
+	return fixed_totals(matrix[start:stop], counts[start:stop], keep, scale)
+
+class Shards:
+	# grouped ballots split up over a pool of processes. The preference matrix goes into shared
+	# memory once, after that every pass only sends out the keep values and adds up the totals.
+	def __init__(self, election, groups, processes: int, scale: int = None):
+		self.order, self.index, padding, matrix = election.preference_matrix(groups)
+		counts = numpy.array([count for ranking, count in groups], dtype=float if scale is None else numpy.int64)
+		self.dtype = counts.dtype
+		self.scale = scale
+
+		self.memory = share_ballots(matrix, counts)
+
+		bounds = numpy.linspace(0, len(matrix), processes + 1).astype(int).tolist()
+		self.shards = [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start != stop]
+		self.pool = ProcessPoolExecutor(
+			processes,
+			initializer = attach_shard,
+			initargs = (self.memory.name, matrix.shape, counts.dtype.str, scale),
+		)
+
+	def distribute(self, keep_values, candidates):
+		keep = numpy.array([keep_values[candidate] for candidate in self.order] + [0], dtype=self.dtype)
+		futures = [self.pool.submit(shard_totals, start, stop, keep) for start, stop in self.shards]
+		# shards are added up in order, so a count with the same shards always gives the same totals
+		totals = numpy.zeros(len(keep), dtype=self.dtype)
+		for future in futures:
+			totals += future.result()
+		convert = float if self.scale is None else int
+		return {candidate: convert(totals[self.index[candidate]]) for candidate in candidates}
+
+	def close(self):
+		self.pool.shutdown()
+		self.memory.close()
+		self.memory.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+# the shared ballots of `SingleTransferableVote.robustness`, as seen from inside a pool process
+sampling = None
+
+def attach_sampling(name: str, shape: tuple, seats: int, order: list[str], empty: int, warm: dict, arithmetic: str, scale: int):
+	global sampling
+	memory, matrix, counts = attach_ballots(name, shape, numpy.dtype(numpy.int64).str)
+	election = SingleTransferableVote(seats, order)
+	sampling = (memory, matrix, numpy.append(counts, empty), election, order, warm, arithmetic, scale)
+
+def count_samples(seeds: list, method: str, perturbation: float):
+	memory, matrix, counts, election, order, warm, arithmetic, scale = sampling
+	index = {candidate: i for i, candidate in enumerate(order)}
+	results = []
+	for seed in seeds:
+		# the last count is the ballots that rank nobody, they still count towards the quota
+		rng = numpy.random.default_rng(seed)
+		if method == "bootstrap":
+			sample = rng.multinomial(counts.sum(), counts / counts.sum())
+		else:
+			sample = rng.binomial(counts, 1 - perturbation)
+
+		distribution = MatrixDistribution(
+			order, index, matrix,
+			sample[:-1] if arithmetic == "fixed" else sample[:-1].astype(float),
+			scale if arithmetic == "fixed" else None,
+		)
+		try:
+			elected = election.count(
+				[], int(sample.sum()), warm = warm, arithmetic = arithmetic, processes = 1, distribution = distribution,
+			)
+			results.append(sorted(elected))
+		except AssertionError:
+			results.append(None)
+	return results
+
+class Trace:
+	# listener that keeps every event of a count, add it to `SingleTransferableVote.listeners`
+	def __init__(self, events: list[dict] = None):
+		self.events = [] if events is None else events
+
+	def __call__(self, event: dict):
+		self.events.append(event)
+
+	def value(self, value):
+		# fixed point counts report whole multiples of 1 / scale, show them as exact decimals
+		scale = self.events[0]["scale"]
+		if scale == 1:
+			return f"{value:.6f}"
+		places = len(str(scale)) - 1
+		return f"{value // scale}.{value % scale:0{places}d}"
+
+	def rows(self):
+		# round by round results table, the first row names the columns
+		if self.events == []:
+			return []
+		candidates = self.events[0]["candidates"]
+		rows = [["round", "iterations", *candidates, "exhausted", "elected", "eliminated"]]
+		for event in self.events:
+			if event["event"] == "round":
+				rows.append([
+					event["round"] + 1,
+					event["iterations"],
+					*[self.value(event["votes"][candidate]) if candidate in event["votes"] else "" for candidate in candidates],
+					self.value(event["exhausted"]),
+					"",
+					"",
+				])
+			elif event["event"] == "elect" and len(rows) > 1:
+				rows[-1][-2] = " ".join(event["candidates"])
+			elif event["event"] == "eliminate":
+				rows[-1][-1] = event["candidate"]
+		return rows
+
+	def write_csv(self, file):
+		csv.writer(file).writerows(self.rows())
 
 class SingleTransferableVote:
+	# fold the ballot journal back into the snapshot after this many appended ballots
+	compact_after = 1000
+
+	# keep values have converged once no pass changes one by more than this
+	tolerance = 0.0001
+	# most passes per round before taking the keep values as they are
+	max_iterations = 1000
+	# "aitken" extrapolation, "relax" for over-relaxation, or "none" for plain Meek iteration
+	acceleration = "aitken"
+	relaxation = 1.5
+
+	# "float" or "fixed", which counts in integers scaled by 10 ** decimal_places so a recount gives
+	# the exact same totals on any machine. Weight is rounded down when transferred and keep values
+	# are rounded up, like the ERS97 rules.
+	arithmetic = "float"
+	decimal_places = 9
+
+	# rules tried in turn when candidates tie for the fewest votes. "backwards" and "forwards" look
+	# for the most recent or the first earlier round where the tied candidates had different totals,
+	# "random" draws one with a generator seeded by `tie_break_seed`.
+	tie_break = ("backwards", "forwards", "random")
+	tie_break_seed = 0
+
+	# processes sharing each counting pass of the numpy backend. Fixed point counts come out exactly
+	# the same as with one process, float totals can differ in the last bits.
+	processes = 1
+
 	def __init__(self, seats: int, candidates: list[str]):
 		self.candidates = set(candidates)
 		self.seats = seats
-		self.votes = {}
+		# finished ballots, a Vote object only exists while someone is still filling theirs in
+		self.votes = BallotStore(self.candidates)
+		self.journaled = 0
+		self.iterations = 0
+		# state of the last count, see `count`
+		self.last_count = None
+		# called with every event of a count, see `Trace`
+		self.listeners = []
 
 		class Vote:
 			@classmethod
@@ -12,15 +544,17 @@ class SingleTransferableVote:
 				vote = Vote(user)
 				for candidate in ranking:
 					vote.submit(candidate)
+				# a stored ranking is complete even if it does not rank everyone
+				if vote.candidates:
+					vote.submit(None)
 				return vote
 
 			def __init__(vote, user):
 				vote.ranking: list[str] = []
+				vote.key: str = str(user)
 				vote.user: int = hash(str(user))
 				vote.candidates: set[str] = self.candidates.copy()
 
-				self.votes[str(user)] = vote
-
 			def submit(vote, choice: str):
 				if choice is None:
 					vote.candidates = set()
@@ -33,6 +567,10 @@ class SingleTransferableVote:
 					vote.ranking.append(choice)
 					vote.candidates.discard(choice)
 
+				# only finished ballots are recorded, so half-cast votes never get counted or saved
+				if not vote.candidates:
+					self.votes.add(vote.key, vote.ranking)
+
 			def choices(vote):
 				if len(vote.candidates) in [0, 1]:
 					return vote.candidates.copy()
@@ -43,82 +581,312 @@ class SingleTransferableVote:
 		self.Vote = Vote
 
 	def save(self, filename):
-		data = {
-			"candidates": list(self.candidates),
-			"seats": self.seats,
-			"votes": {key: self.votes[key].ranking for key in self.votes},
-		}
-		with open(filename, "wb+") as file:
-			pickle.dump(data, file)
-			# print(json.dumps(data), file=file)
+		names = [name.encode() for name in self.votes.names]
+		voter_table, offsets, rankings = self.votes.to_bytes()
+		header = HEADER.pack(
+			MAGIC, VERSION, self.seats, len(names), len(self.votes), len(rankings) // 2, len(voter_table),
+		)
+		candidate_table = b"".join(struct.pack("<H", len(name)) + name for name in names)
+		candidate_table += bytes(-(len(header) + len(candidate_table)) % 8)
+
+		# write the snapshot next to the old one and swap it in, so a crash never leaves half a file
+		with open(f"{filename}.tmp", "wb") as file:
+			for part in [header, candidate_table, voter_table, offsets, rankings]:
+				file.write(part)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(f"{filename}.tmp", filename)
+
+		# every journaled ballot is part of the snapshot now
+		try:
+			os.remove(f"{filename}.log")
+		except FileNotFoundError:
+			pass
+		self.journaled = 0
+
+	def append(self, filename, *users):
+		self.journal(filename, [(str(user), self.votes[str(user)]) for user in users])
+
+	def journal(self, filename, ballots: list[tuple[str, list[str]]]):
+		try:
+			with open(f"{filename}.log", "rb") as file:
+				journal = file.read()
+		except FileNotFoundError:
+			journal = b""
+
+		# journals from before records had checksums are folded into the snapshot first
+		_, end = self.scan_journal(journal)
+		if not journal.startswith(JOURNAL) and end > 0:
+			SingleTransferableVote.compact(filename)
+			end = 0
+
+		# append (user, ranking) ballots as checksummed records, in one write. A record torn by a
+		# crash is cut off first, otherwise its length would swallow the records written after it.
+		records = [pickle.dumps((user, ranking)) for user, ranking in ballots]
+		with open(f"{filename}.log", "ab") as file:
+			file.truncate(end)
+			file.write(
+				(JOURNAL if end == 0 else b"")
+				+ b"".join(RECORD.pack(len(record), zlib.crc32(record)) + record for record in records)
+			)
+			file.flush()
+			os.fsync(file.fileno())
+
+		self.journaled += len(records)
+		if self.journaled >= self.compact_after:
+			# compact from what is on disk, other live copies of this election may have appended too
+			SingleTransferableVote.compact(filename)
+			self.journaled = 0
 
 	@classmethod
 	def load(cls, filename):
 		with open(filename, "rb") as file:
-			data = pickle.load(file)
-		obj = SingleTransferableVote(data["seats"], data["candidates"])
-		obj.votes = {key: obj.Vote.from_list(data["votes"][key], key) for key in data["votes"]}
+			if file.read(len(MAGIC)) == MAGIC:
+				obj = cls.load_mapped(file)
+			else:
+				# elections saved before the binary format, they are converted on their next save
+				file.seek(0)
+				data = pickle.load(file)
+				obj = SingleTransferableVote(data["seats"], data["candidates"])
+				for key, ranking in data["votes"].items():
+					obj.votes.add(key, ranking)
+
+		# replay ballots appended since the last snapshot
+		try:
+			with open(f"{filename}.log", "rb") as file:
+				journal = file.read()
+		except FileNotFoundError:
+			journal = b""
+		ballots, _ = cls.scan_journal(journal)
+		for user, ranking in ballots:
+			obj.votes.add(user, ranking)
+			obj.journaled += 1
 		return obj
 
-	def run(self):
+	@classmethod
+	def load_mapped(cls, file):
+		# map the file instead of reading it, the ballots are used right where they lie
+		view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+		magic, version, seats, candidates, ballots, ranked, voter_bytes = HEADER.unpack_from(view)
+		if version != VERSION:
+			raise ValueError(f"Unsupported ballot file version {version}.")
+
+		names = []
+		position = HEADER.size
+		for _ in range(candidates):
+			(length,) = struct.unpack_from("<H", view, position)
+			names.append(bytes(view[position + 2:position + 2 + length]).decode())
+			position += 2 + length
+		position += -position % 8
+
+		voter_table = view[position:position + voter_bytes]
+		position += voter_bytes
+		offsets = view[position:position + 8 * (ballots + 1)].cast("Q")
+		position += 8 * (ballots + 1)
+		rankings = view[position:position + 2 * ranked].cast("H")
+
+		obj = SingleTransferableVote(seats, names)
+		obj.votes = BallotStore.mapped(names, rankings, offsets, voter_table)
+		return obj
+
+	@classmethod
+	def compact(cls, filename):
+		# fold the journal into the snapshot, this also converts old pickled elections
+		cls.load(filename).save(filename)
+
+	@staticmethod
+	def scan_journal(journal: bytes):
+		# the intact ballots of a journal and where the last of them ends. A record cut short or
+		# garbled by a crash mid-write ends the journal, everything before it is intact.
+		ballots = []
+		if journal.startswith(JOURNAL):
+			position = len(JOURNAL)
+			while position + RECORD.size <= len(journal):
+				length, checksum = RECORD.unpack_from(journal, position)
+				record = journal[position + RECORD.size:position + RECORD.size + length]
+				if len(record) < length or zlib.crc32(record) != checksum:
+					break
+				ballots.append(pickle.loads(record))
+				position += RECORD.size + length
+		else:
+			# journals written before records had checksums
+			position = 0
+			while position + 4 <= len(journal):
+				(length,) = struct.unpack_from("<I", journal, position)
+				if position + 4 + length > len(journal):
+					break
+				ballots.append(pickle.loads(journal[position + 4:position + 4 + length]))
+				position += 4 + length
+		return ballots, position
+
+	def run(self, backend: str = None, warm: bool = True, arithmetic: str = None, processes: int = None):
+		# identical rankings are counted once, weighted by how many voters cast them
+		return self.count(
+			self.group_votes(), len(self.votes), backend, self.last_count if warm else None,
+			arithmetic = arithmetic, processes = processes,
+		)
+
+	def count(
+		self, groups, total_votes: int, backend: str = None, warm: dict = None,
+		tolerance: float = None, max_iterations: int = None, acceleration: str = None, arithmetic: str = None,
+		processes: int = None, distribution = None, tie_break: tuple[str] = None,
+	):
 		# see https://en.wikipedia.org/wiki/Counting_single_transferable_votes#Meek
+		tolerance = self.tolerance if tolerance is None else tolerance
+		max_iterations = self.max_iterations if max_iterations is None else max_iterations
+		acceleration = self.acceleration if acceleration is None else acceleration
+		arithmetic = self.arithmetic if arithmetic is None else arithmetic
+		processes = self.processes if processes is None else processes
+		tie_break = self.tie_break if tie_break is None else tie_break
+
+		if arithmetic == "fixed":
+			# votes and keep values are whole multiples of 1 / scale, `scale` itself stands for 1
+			scale = 10 ** self.decimal_places
+			# keep `tolerance` as given, the sharded count below scales it again
+			threshold = round(tolerance * scale)
+			# exact totals need no slack when looking for ties
+			epsilon = 0
+			# extrapolating would bring floats back in
+			acceleration = "none"
+			# fixed point results must be reproducible by a cold recount, and starting elsewhere converges elsewhere
+			warm = None
+		else:
+			scale = 1
+			threshold = tolerance
+			epsilon = 0.0001
+
+		# `warm` is the `last_count` of an earlier count of this election. Every round starts from
+		# the keep values that round converged to last time, which only takes a pass or two when
+		# few ballots changed. Each decision is still checked against the fresh totals, and once
+		# one differs the rest of the count runs cold.
+		# keep values from the other arithmetic are on a different scale, fixed point counts always run cold
+		if warm is not None and warm.get("arithmetic", "float") == arithmetic:
+			warm_rounds = warm["rounds"]
+		else:
+			warm_rounds = []
+
+		# use the vectorized backend whenever numpy is installed, unless told otherwise
+		if backend is None:
+			backend = "numpy"
+		if distribution is not None:
+			# anything with a `distribute(keep_values, candidates)` pass, like `Shards`
+			distribute = distribution.distribute
+		elif backend == "numpy" and numpy is not None:
+			# split the passes over several processes, int64 fixed point only fits up to 9 decimal places
+			if processes > 1 and (arithmetic != "fixed" or scale * scale < 2 ** 63):
+				with Shards(self, groups, processes, scale if arithmetic == "fixed" else None) as shards:
+					return self.count(
+						groups, total_votes, backend, warm, tolerance, max_iterations, acceleration, arithmetic,
+						processes, shards, tie_break,
+					)
+
+			if arithmetic == "fixed":
+				distribute = self.numpy_fixed_distribution(groups, scale)
+			else:
+				distribute = self.numpy_distribution(groups)
+		else:
+			if arithmetic == "fixed":
+				distribute = self.fixed_distribution(groups, scale)
+			else:
+				distribute = self.python_distribution(groups)
 
-		votes = [vote.ranking.copy() for vote in self.votes.values()]
-		total_votes = len(votes)
 		elected = set()
 		candidates = self.candidates.copy()
-		keep_values = {candidate: 1 for candidate in candidates}
+		keep_values = {candidate: scale for candidate in candidates}
 
-		required_votes = total_votes/(self.seats + 1)
-		print(required_votes)
+		if arithmetic == "fixed":
+			required_votes = total_votes * scale // (self.seats + 1)
+		else:
+			required_votes = total_votes/(self.seats + 1)
+
+		# every step of the count is reported to the listeners, skip building the events when nobody listens
+		trace = self.listeners != []
+		if trace:
+			self.emit(
+				"start", seats = self.seats, candidates = sorted(self.candidates), total_votes = total_votes,
+				quota = required_votes, arithmetic = arithmetic, scale = scale,
+			)
+			seconds = {"distribute": 0, "update": 0}
 
 		times_recalculated = 0
+		# number of full passes over the ballots, kept for benchmarking
+		self.iterations = 0
+		# converged keep values and the decision taken in every round, for warm starting a recount
+		rounds = []
+		self.last_count = {
+			"rounds": rounds, "warm_rounds": 0, "round_iterations": [], "budget_exhausted": False,
+			"arithmetic": arithmetic, "scale": scale,
+		}
+		# plain fixed point iterates of every elected candidate's keep value in this round
+		steps = {}
+		# converged totals of every round, one packed row per round in `order`, for breaking ties
+		order = sorted(self.candidates)
+		history = []
+		draw = random.Random(self.tie_break_seed)
 
 		# repeat until seats are filled or everyone except seat amount is eliminated
 		while (len(elected) < self.seats) and (len(elected) + len(candidates) > self.seats):
-			candidate_votes = {candidate: 0 for candidate in candidates}
-			for vote in votes:
-				remaining_weight = 1
-				for candidate in vote:
-					# skip eliminated candidates
-					if keep_values[candidate] == 0:
-						continue
-
-					assigned_weight = remaining_weight * keep_values[candidate]
-					remaining_weight -= assigned_weight
-					candidate_votes[candidate] += assigned_weight
+			if trace:
+				start = time.perf_counter()
+			candidate_votes = distribute(keep_values, candidates)
+			self.iterations += 1
+			if trace:
+				seconds["distribute"] += time.perf_counter() - start
+				start = time.perf_counter()
 
 			largest_change = 0
 			# recalculate keep_values
 			for candidate in elected:
-				new_keep_value = keep_values[candidate] * required_votes / candidate_votes[candidate]
+				if arithmetic == "fixed":
+					# round up, so an elected candidate never keeps less than the quota
+					new_keep_value = -(-keep_values[candidate] * required_votes // candidate_votes[candidate])
+				else:
+					new_keep_value = keep_values[candidate] * required_votes / candidate_votes[candidate]
 				largest_change = max(largest_change, abs(new_keep_value - keep_values[candidate]))
+				steps.setdefault(candidate, [keep_values[candidate]]).append(new_keep_value)
 				keep_values[candidate] = new_keep_value
 			
 			# if keep_values changed significantly, start over and continue until they don't
-			if largest_change > 0.0001:
+			if largest_change > threshold:
 				times_recalculated += 1
-				continue
-			print()
-			if times_recalculated != 0:
-				print(f"recalculated keep_values {times_recalculated} times")
-				times_recalculated = 0
+				if times_recalculated < max_iterations:
+					self.accelerate(acceleration, steps, keep_values)
+					if trace:
+						seconds["update"] += time.perf_counter() - start
+					continue
+				self.last_count["budget_exhausted"] = True
+				if trace:
+					self.emit("budget_exhausted", round = len(rounds), iterations = times_recalculated)
+			self.last_count["round_iterations"].append(times_recalculated + 1)
+			steps = {}
+			history.append(array("q" if arithmetic == "fixed" else "d", [candidate_votes.get(candidate, 0) for candidate in order]))
 
-			print(f"{keep_values = }")
-			print(f"{candidate_votes = }")
+			if trace:
+				seconds["update"] += time.perf_counter() - start
+				self.emit(
+					"round", round = len(rounds), iterations = times_recalculated + 1,
+					votes = dict(candidate_votes), keep_values = {candidate: keep_values[candidate] for candidate in candidates},
+					# weight of ballots that ran out of preferences
+					exhausted = total_votes * scale - sum(candidate_votes.values()),
+					elected = sorted(elected), seconds = seconds,
+				)
+				seconds = {"distribute": 0, "update": 0}
+			times_recalculated = 0
 			
-			new_elected = False
+			new_elected = []
 			# elect candidates with enough votes
 			for candidate in candidates:
 				if (candidate_votes[candidate] > required_votes) and (candidate not in elected):
-					new_elected = True
+					new_elected.append(candidate)
 
 					elected.add(candidate)
 
-			print(f"{elected = }")
-
 			# if new people were elected start over to recalculate keep_values
 			if new_elected:
+				if trace:
+					self.emit("elect", round = len(rounds), candidates = sorted(new_elected))
+				warm_rounds = self.record_round(rounds, keep_values, ("elect", sorted(elected)), warm_rounds)
+				self.warm_start(rounds, keep_values, new_elected, warm_rounds)
 				continue
 
 			# find candidate with least votes to eliminate
@@ -126,27 +894,281 @@ class SingleTransferableVote:
 			least_candidates = []
 			for candidate in candidates:
 				if candidate in elected: continue
-				if candidate_votes[candidate] < least_votes + 0.0001:
+				if candidate_votes[candidate] <= least_votes + epsilon:
 					least_candidates.append(candidate)
 
+			if len(least_candidates) > 1:
+				tied = sorted(least_candidates)
+				least_candidates, rule = self.break_tie(tied, history, order, tie_break, epsilon, draw)
+				if trace:
+					self.emit("tie", round = len(rounds), candidates = tied, rule = rule, loser = least_candidates[0])
+
 			assert len(least_candidates) == 1, f"There is a tie between the following candidates: {least_candidates}"
 
-			print(f"discarding {least_candidates[0]}")
+			if trace:
+				self.emit("eliminate", round = len(rounds), candidate = least_candidates[0])
 
 			candidates.discard(least_candidates[0])
 			keep_values[least_candidates[0]] = 0
 
+			warm_rounds = self.record_round(rounds, keep_values, ("eliminate", least_candidates[0]), warm_rounds)
+
 		# if seats are not filled, elect all remaining candidates
 		if len(elected) != self.seats:
-			print(f"electing all remaining candidates: {elected = }, {candidates = }")
+			if trace:
+				self.emit("elect", round = len(rounds), candidates = sorted(candidates - elected))
 			# elect all remaining candidates
 			elected.update(candidates)
 
 		assert len(elected) == self.seats
 
+		if trace:
+			self.emit("finish", elected = sorted(elected), iterations = self.iterations)
+
 		return elected
+
+	def break_tie(self, tied: list[str], history: list, order: list[str], rules: tuple[str], epsilon, draw: random.Random):
+		# returns the candidates still tied after the first rule that settles it, and that rule.
+		# the last row of `history` is the round they are tied in.
+		index = {candidate: i for i, candidate in enumerate(order)}
+		for rule in rules:
+			if rule == "random":
+				return [draw.choice(tied)], rule
+			if rule == "backwards":
+				earlier = reversed(history[:-1])
+			elif rule == "forwards":
+				earlier = history[:-1]
+			else:
+				raise ValueError(f"Unknown tie break rule {rule}.")
+
+			# keep whoever had the fewest votes in the first round that tells them apart
+			for totals in earlier:
+				least_votes = min(totals[index[candidate]] for candidate in tied)
+				behind = [candidate for candidate in tied if totals[index[candidate]] <= least_votes + epsilon]
+				if len(behind) < len(tied):
+					tied = behind
+				if len(tied) == 1:
+					return tied, rule
+		return tied, None
+
+	def emit(self, event: str, **data):
+		data["event"] = event
+		for listener in self.listeners:
+			listener(data)
+
+	def accelerate(self, acceleration: str, steps: dict, keep_values: dict):
+		# jump ahead of the plain fixed point iteration. Jumps are only taken while they keep every
+		# keep value in (0, 1], so the count still settles on the same Meek keep values, just in
+		# fewer passes.
+		candidates = [candidate for candidate, iterates in steps.items() if len(iterates) >= 3]
+		if candidates == []:
+			return
+
+		if acceleration == "aitken":
+			# squared vector extrapolation (SQUAREM), a safeguarded Aitken step over all keep values at once
+			x0 = [steps[candidate][-3] for candidate in candidates]
+			x1 = [steps[candidate][-2] for candidate in candidates]
+			x2 = [steps[candidate][-1] for candidate in candidates]
+			r = [b - a for a, b in zip(x0, x1)]
+			v = [c - 2 * b + a for a, b, c in zip(x0, x1, x2)]
+			if not any(v):
+				return
+			step = -(sum(x * x for x in r) / sum(x * x for x in v)) ** 0.5
+
+			# a step of -1 is just the plain iteration, back off towards it until the jump is valid
+			while step < -1:
+				jump = [a - 2 * step * b + step * step * c for a, b, c in zip(x0, r, v)]
+				if all(0 < value <= 1 for value in jump):
+					break
+				step = (step - 1) / 2
+			else:
+				return
+
+		elif acceleration == "relax":
+			# over-relax the last correction of every keep value that is not oscillating
+			jump = []
+			for candidate in candidates:
+				x0, x1, x2 = steps[candidate][-3:]
+				if (x2 - x1) * (x1 - x0) > 0:
+					jump.append(min(max(x1 + self.relaxation * (x2 - x1), 0), 1) or x2)
+				else:
+					jump.append(x2)
+
+		else:
+			return
+
+		for candidate, value in zip(candidates, jump):
+			keep_values[candidate] = value
+			# the iterates start over from the extrapolated values
+			steps[candidate] = [value]
+
+	def record_round(self, rounds, keep_values, decision, warm_rounds):
+		rounds.append((dict(keep_values), decision))
+
+		# keep warm starting only while the count takes the same decisions as last time
+		if len(rounds) <= len(warm_rounds) and warm_rounds[len(rounds) - 1][1] == decision:
+			self.last_count["warm_rounds"] = len(rounds)
+			return warm_rounds
+		return []
+
+	def warm_start(self, rounds, keep_values, new_elected, warm_rounds):
+		# the newly elected candidates start the next round at the keep values they converged to last time,
+		# the ones elected before keep the values this count already converged
+		if len(rounds) < len(warm_rounds):
+			cached, _ = warm_rounds[len(rounds)]
+			for candidate in new_elected:
+				keep_values[candidate] = cached[candidate]
 	
+	def python_distribution(self, groups):
+		# one surplus distribution pass over the grouped ballots
+		def distribute(keep_values, candidates):
+			candidate_votes = {candidate: 0 for candidate in candidates}
+			for ranking, count in groups:
+				remaining_weight = count
+				for candidate in ranking:
+					# skip eliminated candidates
+					if keep_values[candidate] == 0:
+						continue
+
+					assigned_weight = remaining_weight * keep_values[candidate]
+					remaining_weight -= assigned_weight
+					candidate_votes[candidate] += assigned_weight
+			return candidate_votes
+
+		return distribute
+
+	def fixed_distribution(self, groups, scale: int):
+		# the same pass in scaled integers, every transfer is rounded down
+		def distribute(keep_values, candidates):
+			candidate_votes = {candidate: 0 for candidate in candidates}
+			for ranking, count in groups:
+				remaining_weight = count * scale
+				for candidate in ranking:
+					if keep_values[candidate] == 0:
+						continue
+
+					assigned_weight = remaining_weight * keep_values[candidate] // scale
+					remaining_weight -= assigned_weight
+					candidate_votes[candidate] += assigned_weight
+			return candidate_votes
+
+		return distribute
+
+	def preference_matrix(self, groups):
+		# encode candidates as indices, the extra last index pads short rankings
+		order = list(self.candidates)
+		index = {candidate: i for i, candidate in enumerate(order)}
+		padding = len(order)
+
+		# preference matrix of (ballots x rank positions)
+		width = max([len(ranking) for ranking, count in groups], default=0)
+		matrix = numpy.full((len(groups), max(width, 1)), padding, dtype=numpy.intp)
+		for row, (ranking, count) in enumerate(groups):
+			matrix[row, :len(ranking)] = [index[candidate] for candidate in ranking]
+		return order, index, padding, matrix
+
+	def numpy_distribution(self, groups):
+		order, index, padding, matrix = self.preference_matrix(groups)
+		counts = numpy.array([count for ranking, count in groups], dtype=float)
+		return MatrixDistribution(order, index, matrix, counts).distribute
+
+	def numpy_fixed_distribution(self, groups, scale: int):
+		# int64 only fits scale * scale for up to 9 decimal places
+		if scale * scale >= 2 ** 63:
+			return self.fixed_distribution(groups, scale)
+
+		order, index, padding, matrix = self.preference_matrix(groups)
+		counts = numpy.array([count for ranking, count in groups], dtype=numpy.int64)
+		return MatrixDistribution(order, index, matrix, counts, scale).distribute
+
+	def group_votes(self):
+		return self.votes.grouped()
+
+	def standings(self):
+		# first preferences of every candidate, most popular first
+		first = self.votes.tallied().first
+		return sorted(
+			[(name, first[i]) for i, name in enumerate(self.votes.names)],
+			key = lambda standing: -standing[1],
+		)
+
+	def pairwise(self):
+		# pairwise[a][b] is how many voters prefer a over b, ranking a and leaving b unranked counts too
+		tally = self.votes.tallied()
+		names = self.votes.names
+		pairwise = {a: {} for a in names}
+		for i, a in enumerate(names):
+			for j, b in enumerate(names):
+				if i != j:
+					ranked_both = tally.pairs[i][j] + tally.pairs[j][i]
+					pairwise[a][b] = tally.pairs[i][j] + tally.ranked[i] - ranked_both
+		return pairwise
+
+	def robustness(
+		self, samples: int = 1000, method: str = "bootstrap", perturbation: float = 0.05,
+		processes: int = None, seed: int = 0, arithmetic: str = None,
+	):
+		# how often each candidate wins a seat when the count is repeated on randomly varied ballots.
+		# "bootstrap" draws as many ballots as were cast with replacement, "perturb" drops every
+		# ballot with probability `perturbation`. The same seed always gives the same report.
+		if numpy is None:
+			raise ImportError("Robustness analysis needs numpy.")
+		if method not in ["bootstrap", "perturb"]:
+			raise ValueError(f"Unknown resampling method {method}.")
+		arithmetic = self.arithmetic if arithmetic is None else arithmetic
+		scale = 10 ** self.decimal_places
+		if arithmetic == "fixed" and scale * scale >= 2 ** 63:
+			raise ValueError("Robustness analysis in fixed point supports at most 9 decimal places.")
+
+		wins = {candidate: 0 for candidate in sorted(self.candidates)}
+		if len(self.votes) == 0:
+			# there is nothing to resample
+			return {"samples": 0, "failed": 0, "wins": wins, "frequency": {candidate: 0 for candidate in wins}}
+
+		groups = self.group_votes()
+		order, index, padding, matrix = self.preference_matrix(groups)
+		counts = numpy.array([count for ranking, count in groups], dtype=numpy.int64)
+		empty = len(self.votes) - int(counts.sum())
+
+		# every sample starts warm from the count of the actual ballots, most rounds then take a pass or two.
+		# it is counted the way the samples are, and leaves the last count of this election alone
+		reference = SingleTransferableVote(self.seats, list(self.candidates))
+		try:
+			reference.count(groups, len(self.votes), arithmetic = arithmetic)
+			warm = reference.last_count
+		except AssertionError:
+			warm = None
+
+		# the ballots are shared once, a task only carries the seeds of the samples it counts
+		memory = share_ballots(matrix, counts)
+		processes = processes or os.cpu_count()
+		seeds = [[seed, i] for i in range(samples)]
+		size = max(1, samples // (processes * 4))
+		try:
+			with ProcessPoolExecutor(
+				processes,
+				initializer = attach_sampling,
+				initargs = (memory.name, matrix.shape, self.seats, order, empty, warm, arithmetic, scale),
+			) as pool:
+				futures = [pool.submit(count_samples, seeds[i:i + size], method, perturbation) for i in range(0, samples, size)]
+				results = [elected for future in futures for elected in future.result()]
+		finally:
+			memory.close()
+			memory.unlink()
+
+		# samples that ended in a tie elect nobody
+		counted = [elected for elected in results if elected is not None]
+		for elected in counted:
+			for candidate in elected:
+				wins[candidate] += 1
+		return {
+			"samples": samples,
+			"failed": samples - len(counted),
+			"wins": wins,
+			"frequency": {candidate: won / len(counted) if counted else 0 for candidate, won in wins.items()},
+		}
+
 	def get_votes(self):
-		votes = [vote.ranking for vote in self.votes.values()]
+		votes = [ranking for user, ranking in self.votes.items()]
 		votes.sort()
 		return votes
\ No newline at end of file
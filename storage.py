@@ -0,0 +1,415 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from election import SingleTransferableVote
+from workers import run_ballot_io, run_io
+
+class FileStore:
+	# every election is its own json file, with its ballots in votes/
+	def __init__(self, directory: str = "elections"):
+		self.directory = directory
+
+	def path(self, election_id: str):
+		return f"{self.directory}/{election_id}.json"
+
+	def votes_path(self, election_id: str):
+		return f"{self.directory}/votes/{election_id}"
+
+	def read(self, election_id: str):
+		try:
+			with open(self.path(election_id), "r") as file:
+				return json.loads(file.read())
+		except FileNotFoundError:
+			return None
+
+	def write(self, election_id: str, data: dict):
+		with open(self.path(election_id), "w") as file:
+			print(json.dumps(data), file=file)
+
+	def remove(self, election_id: str):
+		os.remove(self.path(election_id))
+		for filename in [self.votes_path(election_id), f"{self.votes_path(election_id)}.log"]:
+			try:
+				os.remove(filename)
+			except FileNotFoundError:
+				pass
+
+	def find(self, guild: int, channel: int = None, status: str = None):
+		# no index, every election of the guild has to be read
+		prefix = f"{guild}_" if channel is None else f"{guild}_{channel}_"
+		elections = []
+		for filename in sorted(os.listdir(self.directory)):
+			if filename.startswith(prefix) and filename.endswith(".json"):
+				data = self.read(filename.removesuffix(".json"))
+				if data is not None and status in [None, data["status"]]:
+					elections.append(data)
+		return elections
+
+	def load_votes(self, election_id: str):
+		return SingleTransferableVote.load(self.votes_path(election_id))
+
+	def save_votes(self, election_id: str, election: SingleTransferableVote):
+		election.save(self.votes_path(election_id))
+
+	def append_votes(self, election_id: str, election: SingleTransferableVote, ballots: list[tuple[str, list[str]]]):
+		election.journal(self.votes_path(election_id), ballots)
+
+	def compact_votes(self, election_id: str):
+		SingleTransferableVote.compact(self.votes_path(election_id))
+
+class SQLiteStore:
+	# all elections in one database, with indexes for finding a guild's or channel's elections
+	schema = """
+		CREATE TABLE IF NOT EXISTS elections (
+			id TEXT PRIMARY KEY,
+			guild INTEGER NOT NULL,
+			channel INTEGER NOT NULL,
+			title TEXT NOT NULL,
+			user TEXT NOT NULL,
+			seats INTEGER NOT NULL,
+			status TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS elections_guild ON elections (guild, channel);
+		CREATE INDEX IF NOT EXISTS elections_channel ON elections (channel);
+		CREATE INDEX IF NOT EXISTS elections_status ON elections (status);
+
+		CREATE TABLE IF NOT EXISTS candidates (
+			election TEXT NOT NULL REFERENCES elections (id) ON DELETE CASCADE,
+			position INTEGER NOT NULL,
+			name TEXT NOT NULL,
+			PRIMARY KEY (election, position)
+		);
+
+		-- the candidates and seats an election was opened with, ballots rank indexes into the sorted candidates
+		CREATE TABLE IF NOT EXISTS vote_sets (
+			election TEXT PRIMARY KEY REFERENCES elections (id) ON DELETE CASCADE,
+			seats INTEGER NOT NULL,
+			candidates TEXT NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS ballots (
+			election TEXT NOT NULL REFERENCES vote_sets (election) ON DELETE CASCADE,
+			voter TEXT NOT NULL,
+			ranking BLOB NOT NULL,
+			PRIMARY KEY (election, voter)
+		);
+	"""
+
+	def __init__(self, filename: str = "elections/elections.db"):
+		self.filename = filename
+		# metadata and ballots are read and written from different threads, each gets its own connection
+		self.connections = threading.local()
+
+		tables = self.connection.execute("SELECT name FROM sqlite_master WHERE name = 'elections'").fetchall()
+		self.created = tables == []
+		with self.connection:
+			self.connection.executescript(self.schema)
+
+	@property
+	def connection(self):
+		if not hasattr(self.connections, "connection"):
+			connection = sqlite3.connect(self.filename)
+			connection.execute("PRAGMA journal_mode = WAL")
+			connection.execute("PRAGMA synchronous = NORMAL")
+			connection.execute("PRAGMA foreign_keys = ON")
+			self.connections.connection = connection
+		return self.connections.connection
+
+	def read(self, election_id: str):
+		row = self.connection.execute(
+			"SELECT guild, channel, user, seats, title, status FROM elections WHERE id = ?",
+			(election_id,),
+		).fetchone()
+		if row is None:
+			return None
+
+		guild, channel, user, seats, title, status = row
+		candidates = self.connection.execute(
+			"SELECT name FROM candidates WHERE election = ? ORDER BY position",
+			(election_id,),
+		).fetchall()
+		return {
+			"guild": guild,
+			"channel": channel,
+			"user": user,
+			"seats": seats,
+			"title": title,
+			"candidates": [name for (name,) in candidates],
+			"status": status,
+		}
+
+	def write(self, election_id: str, data: dict):
+		with self.connection:
+			self.connection.execute(
+				"INSERT INTO elections (id, guild, channel, title, user, seats, status) VALUES (?, ?, ?, ?, ?, ?, ?) "
+				"ON CONFLICT (id) DO UPDATE SET user = excluded.user, seats = excluded.seats, status = excluded.status",
+				(election_id, data["guild"], data["channel"], data["title"], data["user"], data["seats"], data["status"]),
+			)
+			self.connection.execute("DELETE FROM candidates WHERE election = ?", (election_id,))
+			self.connection.executemany(
+				"INSERT INTO candidates (election, position, name) VALUES (?, ?, ?)",
+				[(election_id, position, name) for position, name in enumerate(data["candidates"])],
+			)
+
+	def remove(self, election_id: str):
+		with self.connection:
+			removed = self.connection.execute("DELETE FROM elections WHERE id = ?", (election_id,)).rowcount
+		if removed == 0:
+			raise FileNotFoundError(election_id)
+
+	def find(self, guild: int, channel: int = None, status: str = None):
+		query = "SELECT id FROM elections WHERE guild = ?"
+		parameters = [guild]
+		if channel is not None:
+			query += " AND channel = ?"
+			parameters.append(channel)
+		if status is not None:
+			query += " AND status = ?"
+			parameters.append(status)
+
+		rows = self.connection.execute(query + " ORDER BY title", parameters).fetchall()
+		return [self.read(election_id) for (election_id,) in rows]
+
+	def load_votes(self, election_id: str):
+		row = self.connection.execute(
+			"SELECT seats, candidates FROM vote_sets WHERE election = ?",
+			(election_id,),
+		).fetchone()
+		if row is None:
+			raise FileNotFoundError(election_id)
+
+		election = SingleTransferableVote(row[0], json.loads(row[1]))
+		votes = election.votes
+		# the stored rankings are already packed ids, so they go straight into the ballot store
+		for voter, ranking in self.connection.execute(
+			"SELECT voter, ranking FROM ballots WHERE election = ?",
+			(election_id,),
+		):
+			votes.place(voter, array("H", ranking))
+		return election
+
+	def save_votes(self, election_id: str, election: SingleTransferableVote):
+		ids = election.votes.ids
+		with self.connection:
+			self.connection.execute("DELETE FROM vote_sets WHERE election = ?", (election_id,))
+			self.connection.execute(
+				"INSERT INTO vote_sets (election, seats, candidates) VALUES (?, ?, ?)",
+				(election_id, election.seats, json.dumps(election.votes.names)),
+			)
+			self.connection.executemany(
+				"INSERT INTO ballots (election, voter, ranking) VALUES (?, ?, ?)",
+				[
+					(election_id, voter, array("H", [ids[name] for name in ranking]).tobytes())
+					for voter, ranking in election.votes.items()
+				],
+			)
+
+	def append_votes(self, election_id: str, election: SingleTransferableVote, ballots: list[tuple[str, list[str]]]):
+		ids = election.votes.ids
+		with self.connection:
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO ballots (election, voter, ranking) VALUES (?, ?, ?)",
+				[
+					(election_id, voter, array("H", [ids[name] for name in ranking]).tobytes())
+					for voter, ranking in ballots
+				],
+			)
+
+	def compact_votes(self, election_id: str):
+		# every ballot already sits in its final row
+		pass
+
+	def import_files(self, files: FileStore):
+		# move elections kept as files into the database
+		for filename in os.listdir(files.directory):
+			# views.json is left over from before buttons were dispatched by their custom id
+			if not filename.endswith(".json") or filename == "views.json":
+				continue
+			election_id = filename.removesuffix(".json")
+			self.write(election_id, files.read(election_id))
+			try:
+				self.save_votes(election_id, files.load_votes(election_id))
+			except FileNotFoundError:
+				pass
+
+class ElectionRegistry:
+	def __init__(self, store):
+		self.store = store
+		# election id -> metadata, or None if we already know there is no such election
+		self.elections = {}
+
+	async def get(self, election_id: str):
+		# only touch the store the first time an election is looked up
+		if election_id not in self.elections:
+			self.elections[election_id] = await run_io(self.store.read, election_id)
+
+		data = self.elections[election_id]
+		if data is None:
+			raise FileNotFoundError(election_id)
+		return data
+
+	async def save(self, election_id: str, data: dict):
+		# write through, memory is updated first so readers never see stale data
+		self.elections[election_id] = data
+		await run_io(self.store.write, election_id, dict(data, candidates = list(data["candidates"])))
+
+	async def delete(self, election_id: str):
+		self.elections[election_id] = None
+		# after any ballot work still queued for it, so that can't bring its ballots back
+		await run_ballot_io(election_id, self.store.remove, election_id)
+
+	async def find(self, guild: int, channel: int = None, status: str = None):
+		return await run_io(self.store.find, guild, channel, status)
+
+class ElectionCache:
+	def __init__(self, load, size: int = 32, idle: float = 15 * 60):
+		# load(election_id) builds the live election object on a cache miss
+		self.load = load
+		self.size = size
+		self.idle = idle
+		# election id -> (election, time of last use), least recently used first
+		self.elections = OrderedDict()
+		self.loading = {}
+
+	def __contains__(self, election_id: str):
+		return election_id in self.elections
+
+	async def get(self, election_id: str):
+		self.evict()
+
+		if election_id in self.elections:
+			election, _ = self.elections.pop(election_id)
+		else:
+			# share one load between everyone asking for the same election at once
+			if election_id not in self.loading:
+				self.loading[election_id] = asyncio.ensure_future(run_ballot_io(election_id, self.load, election_id))
+			try:
+				election = await self.loading[election_id]
+			finally:
+				self.loading.pop(election_id, None)
+
+		self.elections[election_id] = (election, time.monotonic())
+		while len(self.elections) > self.size:
+			self.elections.popitem(last=False)
+		return election
+
+	def invalidate(self, election_id: str):
+		self.elections.pop(election_id, None)
+
+	def evict(self):
+		# drop elections nobody has touched in a while
+		cutoff = time.monotonic() - self.idle
+		while self.elections:
+			election_id, (_, last_used) = next(iter(self.elections.items()))
+			if last_used >= cutoff:
+				break
+			del self.elections[election_id]
+
+class BallotWriter:
+	def __init__(self, store, window: float = 0.1):
+		self.store = store
+		# ballots finished within this many seconds of each other share one write
+		self.window = window
+		# election id -> (election, ballots, future set once they are stored)
+		self.pending = {}
+		# election id -> future of the newest batch being written
+		self.writing = {}
+
+	async def commit(self, election_id: str, election, user):
+		# take the ranking now, the voter could start over before the batch is written
+		ballot = (str(user), election.votes[str(user)])
+
+		if election_id not in self.pending:
+			self.pending[election_id] = (election, [], asyncio.get_running_loop().create_future())
+			asyncio.ensure_future(self.flush(election_id))
+
+		_, ballots, written = self.pending[election_id]
+		ballots.append(ballot)
+		await asyncio.shield(written)
+
+	async def flush(self, election_id: str):
+		await asyncio.sleep(self.window)
+
+		# run_ballot_io stores the batches of one election in the order they were flushed
+		election, ballots, written = self.pending.pop(election_id)
+		self.writing[election_id] = written
+		try:
+			await run_ballot_io(election_id, self.store.append_votes, election_id, election, ballots)
+		except Exception as error:
+			written.set_exception(error)
+		else:
+			written.set_result(None)
+		finally:
+			if self.writing.get(election_id) is written:
+				del self.writing[election_id]
+
+	async def flush_pending(self, election_id: str):
+		# wait until every ballot committed so far is stored, a batch that failed was already reported to its voters.
+		# batches are stored in order, so waiting for the newest one is enough
+		if election_id in self.pending:
+			_, _, written = self.pending[election_id]
+		else:
+			written = self.writing.get(election_id)
+		if written is not None:
+			await asyncio.wait([written])
+
+class Standings:
+	def __init__(self, count, interval: float = 60, ballots: int = 25, size: int = 64):
+		# count(election_id, election) counts the ballots cast so far and returns who is elected
+		self.count = count
+		# a provisional result is recounted once this many seconds have passed, or this many ballots came in
+		self.interval = interval
+		self.ballots = ballots
+		# results of this many elections are kept, whichever was counted longest ago goes first
+		self.size = size
+		# election id -> {"elected" or "error", "ballots": ballots counted, "time": when it was counted}
+		self.results = OrderedDict()
+		# election id -> ballots finished since the last count started
+		self.new_ballots = {}
+		self.counting = {}
+
+	def ballot_cast(self, election_id: str):
+		self.new_ballots[election_id] = self.new_ballots.get(election_id, 0) + 1
+
+	def get(self, election_id: str, election):
+		# never waits for a count, everyone asking gets the last result while at most one recount runs
+		result = self.results.get(election_id)
+		new_ballots = self.new_ballots.get(election_id, 0)
+		stale = (
+			result is None
+			or new_ballots >= self.ballots
+			or (new_ballots > 0 and time.monotonic() - result["time"] >= self.interval)
+		)
+		if stale and election_id not in self.counting:
+			self.counting[election_id] = asyncio.ensure_future(self.refresh(election_id, election))
+		return result
+
+	async def refresh(self, election_id: str, election):
+		self.new_ballots[election_id] = 0
+		ballots = len(election.votes)
+		try:
+			result = {"elected": sorted(await self.count(election_id, election))}
+		except AssertionError as assertion:
+			result = {"error": str(assertion)}
+		finally:
+			current = self.counting.get(election_id) is asyncio.current_task()
+			if current:
+				del self.counting[election_id]
+
+		# the election may have been reset while this was counting
+		if current:
+			self.results.pop(election_id, None)
+			self.results[election_id] = dict(result, ballots = ballots, time = time.monotonic())
+			while len(self.results) > self.size:
+				forgotten, _ = self.results.popitem(last=False)
+				self.new_ballots.pop(forgotten, None)
+
+	def invalidate(self, election_id: str):
+		self.results.pop(election_id, None)
+		self.new_ballots.pop(election_id, None)
+		self.counting.pop(election_id, None)
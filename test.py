@@ -1,4 +1,4 @@
-from election import SingleTransferableVote
+from election import SingleTransferableVote, Trace
 
 election = SingleTransferableVote(3, ["a", "b", "c", "d"])
 
@@ -15,4 +15,92 @@ for count, vote in [
 		election.Vote.from_list(vote, f"user{user}")
 		user += 1
 
-election.run()
\ No newline at end of file
+result = election.run()
+assert result == {"a", "b", "c"}, result
+
+# the pure python backend must agree with the numpy one
+assert election.run(backend = "python") == result
+
+# counting in fixed point must elect the same candidates, and both backends must agree exactly
+assert election.run(arithmetic = "fixed", warm = False) == result
+fixed_rounds = election.last_count["rounds"]
+assert election.run(backend = "python", arithmetic = "fixed", warm = False) == result
+assert election.last_count["rounds"] == fixed_rounds
+
+# a fixed point recount never warm starts, so it gives the same keep values as counting cold
+election.Vote.from_list(["c", "d"], "late")
+election.run(arithmetic = "fixed", warm = False)
+cold_rounds = election.last_count["rounds"]
+election.last_count["rounds"] = fixed_rounds
+election.run(arithmetic = "fixed")
+assert election.last_count["rounds"] == cold_rounds
+
+# the trace of a count makes a table with one row per round
+trace = Trace()
+election.listeners.append(trace)
+election.run(warm = False)
+rows = trace.rows()
+assert rows[0][2:6] == ["a", "b", "c", "d"], rows[0]
+assert len(rows) == 1 + len([event for event in trace.events if event["event"] == "round"])
+assert {name for row in rows[1:] for name in row[-2].split()} == result
+
+# b and c tie for the fewest votes once d is out, c had fewer votes the round before
+tie = SingleTransferableVote(1, ["x", "a", "b", "c", "d"])
+user = 0
+for count, vote in [(6, ["x"]), (5, ["a"]), (4, ["b"]), (3, ["c"]), (1, ["d", "c"])]:
+	for _ in range(count):
+		tie.Vote.from_list(vote, f"user{user}")
+		user += 1
+trace = Trace()
+tie.listeners.append(trace)
+assert tie.run() == {"x"}
+assert [(event["rule"], event["loser"]) for event in trace.events if event["event"] == "tie"] == [("backwards", "c")]
+
+# sharding the passes of a fixed point count over processes must not change a single keep value
+if __name__ == "__main__":
+	import random
+	rng = random.Random(0)
+	shared = SingleTransferableVote(3, [f"candidate{i}" for i in range(8)])
+	for user in range(3000):
+		shared.Vote.from_list(rng.sample(sorted(shared.candidates), 8), f"user{user}")
+	shared.run(arithmetic = "fixed", warm = False, processes = 1)
+	serial_rounds = shared.last_count["rounds"]
+	shared.run(arithmetic = "fixed", warm = False, processes = 2)
+	assert shared.last_count["rounds"] == serial_rounds
+
+# a ballot record torn by a crash must not take the ballots appended after it down with it
+import os
+import tempfile
+with tempfile.TemporaryDirectory() as directory:
+	filename = os.path.join(directory, "votes")
+	journaled = SingleTransferableVote(1, ["a", "b"])
+	journaled.save(filename)
+	journaled.Vote.from_list(["a"], "first")
+	journaled.append(filename, "first")
+	with open(f"{filename}.log", "ab") as file:
+		file.write(b"\xff\x00\x00\x00torn")
+	for user in range(40):
+		journaled.Vote.from_list(["b", "a"], f"voter{user}")
+		journaled.append(filename, f"voter{user}")
+	assert len(SingleTransferableVote.load(filename).votes) == 41
+	SingleTransferableVote.compact(filename)
+	assert SingleTransferableVote.load(filename).votes["voter39"] == ["b", "a"]
+
+	# discord ids and other voter names both survive voting again and a round trip through a ballot file
+	keyed = SingleTransferableVote(1, ["a", "b"])
+	for user in ["123456789012345678", "007", "voter", "123456789012345678"]:
+		keyed.Vote.from_list(["a"] if user == "voter" else ["b"], user)
+	keyed.Vote.from_list(["a", "b"], "007")
+	keyed.save(filename)
+	assert dict(SingleTransferableVote.load(filename).votes.items()) == {
+		"123456789012345678": ["b"], "007": ["a", "b"], "voter": ["a"],
+	}
+
+# resampling must not disturb the last count, give the same report for the same seed, and cope with no ballots
+if __name__ == "__main__":
+	last_count = election.last_count
+	report = election.robustness(samples = 20, processes = 1)
+	assert election.last_count is last_count
+	assert report == election.robustness(samples = 20, processes = 2)
+	assert report["samples"] == 20 and sum(report["wins"].values()) == 3 * (20 - report["failed"])
+	assert SingleTransferableVote(1, ["a", "b"]).robustness(samples = 20)["wins"] == {"a": 0, "b": 0}
@@ -0,0 +1,121 @@
+import asyncio
+import csv
+import functools
+import io
+import json
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from election import BallotStore, SingleTransferableVote, Trace
+
+# elections with at least this many ballots are counted in a separate process
+process_count_threshold = 5000
+
+# a single thread runs all metadata access, so writes land on disk in the order they were made
+io_pool = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "election-io")
+# loading, saving and compacting ballots can take seconds, so it gets threads of its own
+# and one big election can't hold up every other command
+ballot_pool = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = "ballot-io")
+# election id -> the last ballot operation queued for it
+ballot_queue = {}
+count_pool = None
+
+async def run_io(function, *args, **kwargs):
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(io_pool, functools.partial(function, *args, **kwargs))
+
+async def run_ballot_io(election_id: str, function, *args, **kwargs):
+	# ballot operations of one election still run one after another, in the order they were asked for
+	loop = asyncio.get_running_loop()
+	previous = ballot_queue.get(election_id)
+
+	async def run():
+		if previous is not None:
+			await asyncio.wait([previous])
+		return await loop.run_in_executor(ballot_pool, functools.partial(function, *args, **kwargs))
+
+	def forget(task):
+		if ballot_queue.get(election_id) is task:
+			del ballot_queue[election_id]
+
+	task = ballot_queue[election_id] = asyncio.ensure_future(run())
+	task.add_done_callback(forget)
+	# a caller giving up must not let the next operation start early
+	return await asyncio.shield(task)
+
+def count(seats: int, candidates: list[str], votes: BallotStore, warm: dict = None, trace: bool = False):
+	return count_groups(seats, candidates, votes.grouped(), len(votes), warm, trace)
+
+def count_groups(seats: int, candidates: list[str], groups, total_votes: int, warm: dict = None, trace: bool = False):
+	election = SingleTransferableVote(seats, candidates)
+	# listeners can't cross into the counting process, send the recorded events back instead
+	events = Trace()
+	if trace:
+		election.listeners.append(events)
+	elected = election.count(groups, total_votes, warm = warm)
+	return elected, election.last_count, events.events
+
+async def run_count(election: SingleTransferableVote, warm: dict = None, trace: Trace = None):
+	global count_pool
+
+	# copy the packed ballots now, voters may still be finishing their ballot while we count
+	votes = election.votes.copy()
+	loop = asyncio.get_running_loop()
+
+	if len(votes) < process_count_threshold:
+		elected, election.last_count, events = await loop.run_in_executor(
+			None,
+			count, election.seats, list(election.candidates), votes, warm, trace is not None,
+		)
+	else:
+		# only ship the distinct rankings to the counting process
+		groups = await loop.run_in_executor(None, votes.grouped)
+		if count_pool is None:
+			count_pool = ProcessPoolExecutor()
+		elected, election.last_count, events = await loop.run_in_executor(
+			count_pool,
+			count_groups, election.seats, list(election.candidates), groups, len(votes), warm, trace is not None,
+		)
+
+	if trace is not None:
+		trace.events += events
+	return elected
+
+def write_results(file, votes: BallotStore, seats: int, elected: list[str], trace: Trace):
+	# one zip with every ballot, the distinct rankings and the count round by round. Every part is
+	# written row by row straight into the compressed file, never built up as one big string.
+	groups = sorted(votes.grouped(), key = lambda group: group[0])
+	with zipfile.ZipFile(file, "w", compression = zipfile.ZIP_DEFLATED) as archive:
+		with archive.open("ballots.csv", "w") as part, io.TextIOWrapper(part, newline = "") as text:
+			# sorted rather than in the order they were cast, so no ballot can be told apart by when it came in
+			writer = csv.writer(text)
+			writer.writerow(["ranking"])
+			# blank rows are ballots that rank nobody
+			for _ in range(len(votes) - sum(count for ranking, count in groups)):
+				writer.writerow([])
+			for ranking, count in groups:
+				for _ in range(count):
+					writer.writerow(ranking)
+
+		with archive.open("groups.csv", "w") as part, io.TextIOWrapper(part, newline = "") as text:
+			writer = csv.writer(text)
+			writer.writerow(["count", "ranking"])
+			for ranking, count in groups:
+				writer.writerow([count, *ranking])
+
+		with archive.open("rounds.csv", "w") as part, io.TextIOWrapper(part, newline = "") as text:
+			trace.write_csv(text)
+
+		with archive.open("results.json", "w") as part, io.TextIOWrapper(part) as text:
+			json.dump({"seats": seats, "elected": elected, "ballots": len(votes), "trace": trace.events}, text)
+
+async def run_export(election: SingleTransferableVote, elected: list[str], trace: Trace):
+	# copy the ballots first, the copy is what the writer thread reads
+	votes = election.votes.copy()
+	# kept in memory while small, larger results go to a temporary file
+	file = tempfile.SpooledTemporaryFile(max_size = 8 * 1024 * 1024)
+	loop = asyncio.get_running_loop()
+	await loop.run_in_executor(None, write_results, file, votes, election.seats, elected, trace)
+	file.seek(0)
+	return file